@@ -0,0 +1,171 @@
+"""
+Works out a video's frame_offset without anyone sitting through the
+calibration window.  A cheap motion signal (how much consecutive, heavily
+downscaled frames differ) is taken from the video around the first
+matched lap, sampled a few times a second, and cross-correlated (via FFT)
+against the lap's speed.  The best lag is the offset, and the correlation
+at that lag says how much to trust it.
+"""
+
+import cv2
+import logging
+import seek_index
+
+import numpy as np
+
+from models import Fix
+
+logger = logging.getLogger(__name__)
+
+# Samples of the motion signal per second of video
+SAMPLE_RATE = 5
+
+# Width frames are shrunk to before they're compared
+SIGNAL_WIDTH = 64
+
+# Furthest (in seconds, either way) the camera clock is expected to be off
+MAX_OFFSET = 60
+
+# How much of the lap to match up, in seconds
+WINDOW = 120
+
+# Estimates with a correlation below this aren't trusted
+MIN_CONFIDENCE = 0.6
+
+
+def motion_signal(video, first_frame, stride, count, width=SIGNAL_WIDTH):
+    """
+    Mean absolute difference between every stride'th frame of video and
+    the sample before it, for up to count samples from first_frame.
+    Frames in between are only grabbed, not converted.  Stops early at the
+    end of the video.
+    """
+    height = max(1, int(round(width * float(video.height) / video.width)))
+
+    caps = {}
+    chapter = None
+    cap = None
+    previous = None
+    signal = []
+    try:
+        for sample in xrange(count):
+            framenum = first_frame + sample * stride
+            index, local_framenum = video.locate_frame(framenum)
+            if index != chapter:
+                if index not in caps:
+                    caps[index] = cv2.VideoCapture(video.filenames[index])
+                cap = caps[index]
+                seek_index.seek(cap, local_framenum,
+                                index=seek_index.get_index(video.filenames[index]))
+                chapter = index
+            else:
+                for _ in xrange(stride - 1):
+                    cap.grab()
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                               (width, height), interpolation=cv2.INTER_AREA)
+            small = small.astype(np.float32)
+            if previous is not None:
+                signal.append(np.abs(small - previous).mean())
+            previous = small
+    finally:
+        for cap in caps.values():
+            cap.release()
+
+    if not signal:
+        return np.zeros(0)
+
+    # The first sample has nothing to compare against, so repeat the second
+    return np.array(signal[:1] + signal, dtype=np.float64)
+
+
+def correlate(signal, reference):
+    """
+    Pearson correlation of reference against each len(reference) long
+    window of signal, i.e. result[lag] compares signal[lag:lag + n] with
+    reference.  One FFT product gives all of the lags at once.
+    """
+    n = len(reference)
+    lags = len(signal) - n + 1
+    if n < 2 or lags < 1:
+        return np.zeros(0)
+
+    spread = reference.std()
+    if not spread:
+        return np.zeros(lags)
+    reference = (reference - reference.mean()) / spread
+
+    size = 1 << int(np.ceil(np.log2(len(signal) + n)))
+    products = np.fft.irfft(np.fft.rfft(signal, size) *
+                            np.conj(np.fft.rfft(reference, size)), size)[:lags]
+
+    # Each window's own mean/std, from running sums.  reference sums to
+    # zero so the window's mean drops out of the products
+    sums = np.concatenate(([0.0], np.cumsum(signal)))
+    squares = np.concatenate(([0.0], np.cumsum(signal ** 2)))
+    means = (sums[n:] - sums[:-n]) / n
+    variances = (squares[n:] - squares[:-n]) / n - means ** 2
+
+    result = np.zeros(lags)
+    ok = variances > 1e-12
+    result[ok] = products[ok] / (n * np.sqrt(variances[ok]))
+    return result
+
+
+def estimate_offset(video, lapinfo=None, max_offset=MAX_OFFSET, window=WINDOW,
+                    sample_rate=SAMPLE_RATE):
+    """
+    (frame_offset, confidence) for video, going by lapinfo (its first
+    matched lap by default).  confidence is the correlation between the
+    motion signal and the lap's speed at that offset, anything much below
+    MIN_CONFIDENCE is likely to be a guess.  Returns (None, 0) when there's
+    not enough to go on.
+    """
+    if lapinfo is None:
+        if not video.matched_laps:
+            return None, 0.0
+        lapinfo = video.matched_laps[0]
+
+    lap = lapinfo["lap"]
+    stride = max(1, int(round(video.fps / sample_rate)))
+    step = stride / float(video.fps)
+
+    seconds = np.arange(0, min(window, lap.lap_time), step)
+    speed = np.asarray(lap.get_metric_at_time(Fix.SPEED_MPH, seconds), dtype=np.float64)
+    if len(speed) < 2 or not speed.std():
+        return None, 0.0
+
+    # Look up to max_offset either side of where the lap should start (as
+    # far as the start of the video allows)
+    start_frame = int(lapinfo["start_frame"])
+    max_lag = int(max_offset / step)
+    before = min(max_lag, max(start_frame, 0) // stride)
+    first_frame = start_frame - before * stride
+
+    logger.info("Estimating the offset of %s from %s samples..." % (
+        video.file_basenames(), len(speed) + before + max_lag))
+    motion = motion_signal(video, first_frame, stride, len(speed) + before + max_lag)
+
+    correlation = correlate(motion, speed)
+    if not len(correlation):
+        return None, 0.0
+
+    best = int(np.argmax(correlation))
+    confidence = max(0.0, float(correlation[best]))
+
+    # Fit a parabola through the peak to get below the sample spacing
+    shift = 0.0
+    if 0 < best < len(correlation) - 1:
+        left, peak, right = correlation[best - 1:best + 2]
+        curve = left - 2 * peak + right
+        if curve < 0:
+            shift = 0.5 * (left - right) / curve
+
+    offset = int(round((best + shift - before) * stride))
+    logger.info("%s looks to be offset by %s frames (confidence %.2f)" % (
+        video.file_basenames(), offset, confidence))
+    return offset, confidence
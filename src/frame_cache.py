@@ -0,0 +1,176 @@
+"""
+Decoded frames around a cursor, for scrubbing through a video (the manual
+calibration window).  A background thread keeps the frames either side of
+the cursor, and around the page up / page down targets, decoded at a
+reduced preview size, reading sequentially wherever it can since seeking
+long-GOP footage is slow.  Frames furthest from the cursor are dropped
+first once the cache is full.
+"""
+
+import cv2
+import logging
+import seek_index
+import sys
+
+from threading import Condition, Thread
+
+logger = logging.getLogger(__name__)
+
+# Frames kept decoded either side of the cursor
+RADIUS = 60
+
+# How far page up / page down jump, and how much is decoded around there
+PAGE_FRAMES = 300
+PAGE_RADIUS = 15
+
+PREVIEW_WIDTH = 640
+
+
+class FrameCache(object):
+    def __init__(self, video, radius=RADIUS, page_frames=PAGE_FRAMES,
+                 page_radius=PAGE_RADIUS, width=PREVIEW_WIDTH):
+        self.video = video
+        self.radius = radius
+        self.page_frames = page_frames
+        self.page_radius = page_radius
+        self.width = min(width, video.width)
+        self.height = max(1, int(round(self.width * float(video.height) / video.width)))
+        self.capacity = 2 * (radius + 1) + 4 * (page_radius + 1)
+
+        self._frames = {}
+        self._cursor = 0
+        self._stopped = False
+        # What killed the background thread, if anything did
+        self._error = None
+        self._condition = Condition()
+        self._thread = None
+
+    def start(self, framenum=0):
+        self._cursor = framenum
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+        if self._thread:
+            self._thread.join()
+
+    def get(self, framenum):
+        """Preview sized framenum (None if it can't be decoded), waiting for
+        it if it hasn't been decoded yet.  Also moves the cursor there.
+        Raises whatever stopped the background thread decoding, if it
+        died."""
+        if not 0 <= framenum < self.video.frame_count:
+            return None
+
+        with self._condition:
+            if framenum != self._cursor:
+                self._cursor = framenum
+                self._condition.notify_all()
+
+            while framenum not in self._frames and not self._stopped:
+                self._condition.wait(0.1)
+
+            if framenum not in self._frames and self._error:
+                raise self._error[0], self._error[1], self._error[2]
+            return self._frames.get(framenum)
+
+    def _ranges(self, cursor):
+        # What should be decoded, most wanted first
+        ranges = [(cursor, cursor + self.radius),
+                  (cursor - self.radius, cursor - 1)]
+        for target in (cursor + self.page_frames, cursor - self.page_frames):
+            ranges.append((target - self.page_radius, target + self.page_radius))
+
+        last = self.video.frame_count - 1
+        return [(max(first, 0), min(end, last)) for first, end in ranges
+                if end >= 0 and first <= last]
+
+    def _next_missing(self):
+        # (first frame not decoded yet, end of its range), or None
+        for first, end in self._ranges(self._cursor):
+            for framenum in xrange(first, end + 1):
+                if framenum not in self._frames:
+                    return framenum, end
+
+        return None
+
+    def _store(self, framenum, frame):
+        if frame is not None:
+            frame = cv2.resize(frame, (self.width, self.height),
+                               interpolation=cv2.INTER_AREA)
+
+        with self._condition:
+            self._frames[framenum] = frame
+            if len(self._frames) > self.capacity:
+                # Drop whatever's furthest away of what isn't wanted any more
+                # (the ranges always fit, so that's enough)
+                ranges = self._ranges(self._cursor)
+                stale = [f for f in self._frames
+                         if not any([first <= f <= end for first, end in ranges])]
+                stale.sort(key=lambda f: abs(f - self._cursor), reverse=True)
+                for f in stale[:len(self._frames) - self.capacity]:
+                    del self._frames[f]
+            self._condition.notify_all()
+            return self._cursor
+
+    def _run(self):
+        caps = {}
+        # Next frame each capture will read
+        positions = {}
+        try:
+            while True:
+                with self._condition:
+                    while not self._stopped and self._next_missing() is None:
+                        self._condition.wait()
+                    if self._stopped:
+                        break
+                    framenum, end = self._next_missing()
+                    cursor = self._cursor
+
+                # Read on through the range until it's done or the cursor moves
+                while framenum <= end:
+                    index, local_framenum = self.video.locate_frame(framenum)
+                    filename = self.video.filenames[index]
+                    if index not in caps:
+                        caps[index] = cv2.VideoCapture(filename)
+                        positions[index] = 0
+                    cap = caps[index]
+
+                    if local_framenum != positions[index]:
+                        logger.debug("Seeking to %s" % framenum)
+                        seek_index.seek(cap, local_framenum, positions[index],
+                                        seek_index.get_index(filename))
+
+                    ret, frame = cap.read()
+                    positions[index] = local_framenum + 1
+                    if not ret:
+                        # Past the end (or broken), start afresh next time
+                        cap.release()
+                        del caps[index]
+                        self._store(framenum, None)
+                        break
+
+                    if self._store(framenum, frame) != cursor:
+                        break
+
+                    # Anything already decoded gets skipped over
+                    framenum += 1
+                    if framenum in self._frames:
+                        break
+        except Exception:
+            logger.exception("Frame cache for %s stopped" % self.video.file_basenames())
+            with self._condition:
+                self._error = sys.exc_info()
+        finally:
+            for cap in caps.values():
+                cap.release()
+
+            # Nothing more is coming, don't leave get() waiting
+            with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
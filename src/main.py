@@ -1,5 +1,6 @@
 import argparse
 import logging
+import multiprocessing
 import parsers
 import os
 import sys
@@ -7,9 +8,13 @@ from gooey import Gooey, GooeyParser
 from picker import Picker
 from threading import Thread
 
-from models import Fix, Lap, Session, Day
+from models import Fix, Lap, Session, Day, match_laps
 from renderers import LikeHarrysRenderer
-from utils import collect_videos, load_config, save_config
+from renderers.pipeline import RenderWorkers
+import autosync
+import seek_index
+import telemetry_cache
+from utils import collect_videos, load_config, save_config, to_epoch
 import youtube
 
 import argparse
@@ -55,6 +60,18 @@ def build_parser():
                         widget="DirChooser",
                         help='Folder containing Input structured data telemetry file')
 
+    parser.add_argument('--no-telemetry-cache', dest='telemetry_cache',
+                        action='store_false',
+                        help='Always parse telemetry files, bypassing the parsed telemetry cache')
+
+    parser.add_argument('--rebuild-telemetry-cache', dest='rebuild_telemetry_cache',
+                        action='store_true',
+                        help='Re-parse telemetry files and replace their cache entries')
+
+    parser.add_argument('--telemetry-workers', dest='telemetry_workers',
+                        type=int, default=None,
+                        help='Number of processes used to parse an input data file directory (default: one per core)')
+
     parser.add_argument('-vd', '--video-directory', dest='videodir',
                         type=str,
                         nargs='+',
@@ -65,6 +82,11 @@ def build_parser():
                         action='store_true',
                         help='Search for videos recursively')
 
+    parser.add_argument('--skip-videos', dest='skip_videos',
+                        type=str,
+                        nargs='+',
+                        help='Globs of video files or folders to leave out, e.g. "*.LRV" or "2015-*"')
+
     parser.add_argument("-v", '--verbose', dest='info_verbose',
                         action='store_true',
                         help='Enable verbose logging')
@@ -90,6 +112,15 @@ def build_parser():
                         dest="force_manual_offset", action='store_true',
                         help="Force display of the manual offset calibration feature. To be used if stored offset is innaccurate.")
 
+    parser.add_argument("-ao", "--auto-offset",
+                        dest="auto_offset", action='store_true',
+                        help="Estimate the offset of uncalibrated videos by matching on-screen motion against the telemetry.  Manual calibration is only used for estimates that don't look reliable.")
+
+    parser.add_argument("--auto-offset-confidence",
+                        dest="auto_offset_confidence", type=float,
+                        default=autosync.MIN_CONFIDENCE,
+                        help="How well (0-1) the video has to match the telemetry for an automatic offset to be used (default: %s)" % autosync.MIN_CONFIDENCE)
+
     parser.add_argument("-y", "--enable-youtube",
                         dest="youtube", action='store_true',
                         help="Upload all laps to youtube")
@@ -110,6 +141,14 @@ def build_parser():
                         dest="show_video", action='store_true',
                         help="Show the video during the rendering process.  Slows down rendering a little bit.")
 
+    parser.add_argument("--render-workers",
+                        dest="render_workers", type=int, default=1,
+                        help="Number of processes drawing overlays while rendering (default: 1, rendering in a single process).  Checked against single process rendering on the first lap before it's used")
+
+    parser.add_argument("--frame-memory",
+                        dest="frame_memory", type=int, default=1024,
+                        help="Megabytes of decoded frames to buffer while rendering (default: 1024)")
+
     parser.add_argument("-b", "--bookend-time",
                         dest="bookend_time", type=int,
                         default=8,
@@ -225,14 +264,82 @@ def generate_metadata(videofile, params, renderer, args):
     return renderer.generate_metadata(args, params)
 
 
-def get_laps(filename):
-    parserClass = parsers.find_parser(filename)
+def get_laps(filename, use_cache=True, rebuild_cache=False, parserClass=None):
+    if not parserClass:
+        parserClass = parsers.find_parser(filename)
 
     logger.info("Parsing telemetry from %s with %s" % (filename, parserClass))
-    laps = parserClass.parse_data(open(filename), filename=filename)
+    if use_cache:
+        laps = telemetry_cache.get_laps(filename, parserClass, rebuild=rebuild_cache)
+    else:
+        with open(filename) as datafile:
+            laps = list(parserClass.iter_laps(datafile, filename=filename))
     logger.info("Found %s laps" % len(laps))
     return laps
 
+def _ingest_telemetry_file(job):
+    # Runs in a worker process.  With the cache on, the worker only needs
+    # to get the cache entry built, the parent then maps it back in
+    # instead of having every lap pickled back across
+    filename, parserClass, use_cache, rebuild_cache = job
+    laps = get_laps(filename, use_cache, rebuild_cache, parserClass)
+    if use_cache:
+        return None
+
+    return laps
+
+
+def get_laps_from_directory(datafile_dir, use_cache=True, rebuild_cache=False,
+                            workers=None, time_ranges=None):
+    filenames = sorted([os.path.join(datafile_dir, fn) for fn in os.listdir(datafile_dir)])
+    catalog = parsers.build_catalog(filenames)
+
+    if time_ranges is not None:
+        # Only bother with files that overlap something we can render
+        catalog = [entry for entry in catalog
+                   if any([entry.overlaps(start, end) for start, end in time_ranges])]
+        logger.info("%s telemetry files overlap the videos" % len(catalog))
+
+    found = [(entry.filename, entry.parser) for entry in catalog]
+
+    # Anything with an up to date cache entry can just be mapped in,
+    # only the rest needs parsing
+    results = {}
+    if use_cache and not rebuild_cache:
+        for filename, parserClass in found:
+            results[filename] = telemetry_cache.load_laps(filename, parserClass)
+
+    jobs = [(filename, parserClass, use_cache, rebuild_cache)
+            for filename, parserClass in found
+            if results.get(filename) is None]
+
+    workers = min(workers or multiprocessing.cpu_count(), len(jobs))
+    if workers <= 1:
+        for filename, parserClass, _, _ in jobs:
+            results[filename] = get_laps(filename, use_cache, rebuild_cache, parserClass)
+    else:
+        logger.info("Parsing %s telemetry files with %s processes" % (len(jobs), workers))
+        pool = multiprocessing.Pool(workers)
+        try:
+            parsed = pool.map(_ingest_telemetry_file, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for job, laps in zip(jobs, parsed):
+            results[job[0]] = laps
+
+    # Merge in sorted filename order so runs are repeatable
+    laps = []
+    for filename, parserClass in found:
+        file_laps = results.get(filename)
+        if file_laps is None:
+            file_laps = get_laps(filename, use_cache, False, parserClass)
+        laps.extend(file_laps)
+
+    return laps
+
+
 def update_cfg(cfg, args):
     arg_cfg = {}
     try:
@@ -271,21 +378,33 @@ if __name__ == '__main__':
     laps = []
     if args.datafile:
         datafile = ' '.join(args.datafile)
-        laps = get_laps(datafile)
+        laps = get_laps(datafile, args.telemetry_cache, args.rebuild_telemetry_cache)
+
+    # Find the videos first so we only have to load telemetry that
+    # overlaps them
+    videos = []
+    time_ranges = None
+    if args.videodir and not args.analyze_data:
+        videodir = ' '.join(args.videodir)
+        videos = collect_videos(videodir, args.recursive, args.skip_videos)
+        time_ranges = [(to_epoch(video.start_time),
+                        video.end_time and to_epoch(video.end_time))
+                       for video in videos]
 
     if args.datafile_dir:
         datafile_dir = ' '.join(args.datafile_dir)
-        files = os.listdir(datafile_dir)
-        for datafile in files:
-            laps.extend(get_laps(os.path.join(datafile_dir, datafile)))
+        laps.extend(get_laps_from_directory(datafile_dir,
+                                            args.telemetry_cache,
+                                            args.rebuild_telemetry_cache,
+                                            args.telemetry_workers,
+                                            time_ranges))
 
     if args.analyze_data:
         print_lap_stats(laps)
         sys.exit(0)
 
-    if args.videodir:
-        videodir = ' '.join(args.videodir)
-        videos = collect_videos(videodir, laps)
+    # Only now that the videos are grouped and the laps loaded
+    match_laps(videos, laps)
 
     if args.trackname:
         for video in videos:
@@ -343,7 +462,12 @@ if __name__ == '__main__':
             else:
                 select_laps_to_render(matched_videos, args.lap_comparison, args.render_sessions)
 
-    if args.manual_offset or args.force_manual_offset:
+    # Syncing and rendering both seek around these, index them now
+    seek_index.index_videos([filename for video in matched_videos
+                             if any(lap.get('render') for lap in video.matched_laps)
+                             for filename in video.filenames])
+
+    if args.auto_offset or args.manual_offset or args.force_manual_offset:
         for video in matched_videos:
             has_renderable_laps = False
             for lap in video.matched_laps:
@@ -352,7 +476,25 @@ if __name__ == '__main__':
                     break
             if has_renderable_laps and (
                     offsets.get(video.filenames[0]) is None or args.force_manual_offset):
-                offset = video.calibrate_offset()
+                offset = None
+                if args.auto_offset:
+                    estimate, confidence = autosync.estimate_offset(video)
+                    if estimate is not None and confidence >= args.auto_offset_confidence:
+                        offset = estimate
+                    elif estimate is not None:
+                        logger.warning("Automatic offset for %s isn't reliable (confidence %.2f)" % (
+                            video.file_basenames(), confidence))
+                        if args.manual_offset:
+                            # Not sure enough, but it's a better place to start from
+                            video.frame_offset = estimate
+
+                if args.force_manual_offset or (offset is None and args.manual_offset):
+                    offset = video.calibrate_offset()
+
+                if offset is None:
+                    continue
+
+                video.frame_offset = offset
                 offsets[str(video.filenames[0])] = offset
                 cfg.offsets = offsets
                 save_config(cfg)
@@ -364,6 +506,12 @@ if __name__ == '__main__':
         video_id = youtube.upload_video(lapvideo, md)
         print "Upload Complete!  Visit at https://www.youtube.com/watch?v=%s" % video_id
 
+    # Forked now, before there are any upload threads about
+    render_pool = None
+    if args.render_workers > 1 and not args.lap_comparison:
+        render_pool = RenderWorkers.for_videos(matched_videos, args.render_workers,
+                                               args.frame_memory * 1024 * 1024)
+
     if args.lap_comparison:
         dual_vids = [v for v in matched_videos if v.renderable_laps()]
         if len(dual_vids) == 1:
@@ -375,15 +523,22 @@ if __name__ == '__main__':
         for (lapvideo, params) in dr.render_laps(args.outputdir or "/tmp/",
                                     args.show_video,
                                     args.bookend_time,
-                                    render_laps_uniquely=False):
+                                    render_laps_uniquely=False,
+                                    frame_memory=args.frame_memory * 1024 * 1024):
             if args.youtube:
                 Thread(target=upload, args=(lapvideo, params, dr, args)).start()
     else:
-        for video in matched_videos:
-            renderer = LikeHarrysRenderer(video)
-            for (lapvideo, params) in renderer.render_laps(args.outputdir or "/tmp/",
-                                                 args.show_video,
-                                                 args.bookend_time,
-                                                 render_laps_uniquely=(not args.render_sessions)):
-                if args.youtube:
-                    Thread(target=upload, args=(lapvideo, params, renderer, args)).start()
+        try:
+            for video in matched_videos:
+                renderer = LikeHarrysRenderer(video)
+                for (lapvideo, params) in renderer.render_laps(args.outputdir or "/tmp/",
+                                                     args.show_video,
+                                                     args.bookend_time,
+                                                     render_laps_uniquely=(not args.render_sessions),
+                                                     pool=render_pool,
+                                                     frame_memory=args.frame_memory * 1024 * 1024):
+                    if args.youtube:
+                        Thread(target=upload, args=(lapvideo, params, renderer, args)).start()
+        finally:
+            if render_pool is not None:
+                render_pool.close()
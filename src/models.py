@@ -1,22 +1,26 @@
+import bisect
 import config
 import cv2
 import logging
-import json
 import math
+import numpy as np
 import os
 import pytz
 import settings
 import subprocess
+import tempfile
 import time
 import tzlocal
 import wave
 
 import utils
+import video_store
 
 
 from dateutil import parser
+from frame_cache import FrameCache
 from datetime import datetime, timedelta
-from utils import creation_time, within_x_sec, gopro_video_names_in_order, extract_audio
+from utils import within_x_sec, extract_audio
 
 
 from renderers import RenderParams, LapRenderParams
@@ -34,6 +38,7 @@ class Video(object):
         self.filenames = [filename]
         self.filebase = os.path.basename(filename[0])
         self.file_frame_boundaries = []
+        self.chapter_offsets = [0]
         self.file_start_date = None
         self.last_modified_at = None
         self.last_access_at = None
@@ -45,44 +50,77 @@ class Video(object):
         self.height = None
         self.duration = None
         self.matched_laps = []
+        self.lap_frame_ranges = np.zeros((0, 2))
         self.frame_offset = 0
         self.trackname = ""
         self._calc_times()
 
+    def _index_chapters(self):
+        # The first frame of each file, in whole-video frames
+        self.chapter_offsets = [0] + list(self.file_frame_boundaries)
+
+    def locate_frame(self, framenum):
+        """(index into filenames, frame within that file) for framenum"""
+        index = max(bisect.bisect_right(self.chapter_offsets, framenum) - 1, 0)
+        return index, framenum - self.chapter_offsets[index]
+
     def filename_number(self, framenum):
-        index = 0
-        for boundary in self.file_frame_boundaries:
-            if framenum < boundary:
-                return index
-            index += 1
+        return self.locate_frame(framenum)[0]
+
+    def chapter_spans(self, start_time, duration):
+        """
+        (filename, seconds into that file, seconds) for each file that
+        duration seconds of video from start_time (seconds into the whole
+        video) cover
+        """
+        end_time = start_time + duration
+        starts = [offset / float(self.fps) for offset in self.chapter_offsets]
+        ends = starts[1:] + [float("inf")]
+
+        spans = []
+        for filename, begin, end in zip(self.filenames, starts, ends):
+            first = max(start_time, begin)
+            length = min(end_time, end) - first
+            if length > 1e-6:
+                spans.append((filename, first - begin, length))
+
+        if not spans:
+            index = self.filename_number(int(start_time * self.fps))
+            spans.append((self.filenames[index], start_time - starts[index], duration))
+
+        return spans
+
+    def extract_audio(self, newaudiofile, start_time, duration):
+        """Write duration seconds of audio from start_time (seconds into the
+        whole video) to newaudiofile, stitched together across files"""
+        spans = self.chapter_spans(start_time, duration)
+        if len(spans) == 1:
+            extract_audio(spans[0][0], newaudiofile, spans[0][1], spans[0][2])
+            return
 
-        return index
+        tempfiles = []
+        for filename, start, length in spans:
+            outfile = "%s.wav" % tempfile.NamedTemporaryFile().name
+            tempfiles.append(outfile)
+            extract_audio(filename, outfile, start, length)
+
+        utils.combine_audio(tempfiles, newaudiofile)
+
+        for temp in tempfiles:
+            os.unlink(temp)
 
     def file_basenames(self):
         return ",".join([os.path.basename(fn) for fn in self.filenames])
 
-    def find_video_predecessor(self, videos):
-        for video in videos:
-            if (within_x_sec(3, self.end_time, video.start_time) or
-                within_x_sec(3, self.start_time, video.end_time) or
-                gopro_video_names_in_order(self.filenames, video.filenames)
-            ):
-                # Figure out which has earliest start, append all videos from newer one,
-                # resort filenames by start time / filename, redo all internal calculations
-                old = self
-                new = video
-                if self.start_time > video.start_time:
-                    old = video
-                    new = self
-
-                logger.debug("Merging %s and %s" % (old.file_basenames(), new.file_basenames()))
-                # TODO: Use basenames when sorting?
-                old.filenames.extend(new.filenames)
-                old.filenames.sort()
-                old._calc_times()
-                return old, new
-
-        return None, None
+    def append_chapter(self, video):
+        """Carry on into video, the next chapter of the same recording"""
+        self.file_frame_boundaries.append(self.frame_count)
+        self.file_frame_boundaries.extend([self.frame_count + boundary
+                                           for boundary in video.file_frame_boundaries])
+        self.filenames.extend(video.filenames)
+        self._index_chapters()
+        self.frame_count += video.frame_count
+        self.duration = timedelta(seconds=self.frame_count / video.fps)
 
     def _calc_times(self):
         # Open the file, find timestmps etc.
@@ -91,62 +129,52 @@ class Video(object):
         self.last_access_at = datetime.fromtimestamp(res.st_atime)
         self.created_at =  datetime.fromtimestamp(res.st_ctime)
 
-        # Check the cache and see if we've analyzed this video before
-        # If we have and last_modified_at is the same
-        # then restore old config and skip actual (slow) calculations
-        cfg = utils.load_config()
-        cfg_key = ",".join(self.filenames)
-        video_cache = {}
-        old_cfg = {}
-        try:
-            video_cache = cfg.video_cache
-            old_cfg = json.loads(video_cache.get(cfg_key, {}))
-        except:
-            pass
-
-        if old_cfg.get("last_modified_at") == self.last_modified_at.strftime("%s.%f"):
-            logger.debug("Using cached video config data")
-            self.from_dict(old_cfg)
-            return
-
         # Don't bother with obviously not video files
         _, ext = os.path.splitext(self.filenames[0])
         if ext.lower() not in settings.VALID_VIDEO_EXTENSIONS:
             return
 
-        cap = None
-        # Verify that it's a valid video that cv2 can inspect,
-        # record some video metadata whilst its open
-        try:
-            cap = cv2.VideoCapture(self.filenames[0])
-            self.fps = cap.get(cv2.cv.CV_CAP_PROP_FPS)
-            self.frame_count = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
-            self.duration = timedelta(seconds=self.frame_count / self.fps)
-            self.width  = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH))
-            self.height = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
-            cap.release()
-
-            if len(self.filenames) > 1:
-                for filename in self.filenames[1:]:
-                    cap = cv2.VideoCapture(filename)
-                    fps = cap.get(cv2.cv.CV_CAP_PROP_FPS)
-                    self.file_frame_boundaries.append(self.frame_count)
-                    self.frame_count += int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
-                    self.duration = timedelta(seconds=self.frame_count / fps)
-                    cap.release()
-        except:
+        # Chapters after the first just add frames
+        chapters = [self._probe(filename) for filename in self.filenames]
+        if not all(chapter["valid"] for chapter in chapters):
             return
 
-        self.file_start_date = creation_time(self.filenames[0])
+        first = chapters[0]
+        self.fps = first["fps"]
+        self.width = first["width"]
+        self.height = first["height"]
+        self.frame_count = first["frame_count"]
+        self.file_frame_boundaries = []
+        fps = self.fps
+        for chapter in chapters[1:]:
+            self.file_frame_boundaries.append(self.frame_count)
+            self.frame_count += chapter["frame_count"]
+            fps = chapter["fps"]
+        self.duration = timedelta(seconds=self.frame_count / fps)
+        self._index_chapters()
+
+        self.file_start_date = None
+        if first["creation_time"] is not None:
+            self.file_start_date = datetime.fromtimestamp(first["creation_time"],
+                                                          tzlocal.get_localzone())
         self.is_valid_video = True
 
-        video_cache[cfg_key] = json.dumps(self.to_dict())
-        cfg.video_cache = video_cache
-        utils.save_config(cfg)
+    def _probe(self, filename):
+        """fps, frame count etc. of one file, from the video store if we've
+        looked at it before"""
+        metadata = video_store.lookup(filename)
+        if metadata is not None:
+            logger.debug("Using stored metadata for %s" % filename)
+            return metadata
+
+        metadata = utils.probe_video(filename)
+        video_store.record(filename, metadata)
+        return metadata
 
     def to_dict(self):
         data = self.__dict__.copy()
         del data['matched_laps']
+        del data['lap_frame_ranges']
         for dt in self.datetimes:
             if getattr(self, dt):
               data[dt] = getattr(self, dt).strftime("%s.%f")
@@ -166,6 +194,7 @@ class Video(object):
                 setattr(self, k, val)
 
         self.duration = timedelta(seconds=float(data['duration']))
+        self._index_chapters()
 
     def renderable_laps(self):
         return [m for m in self.matched_laps if m['render']]
@@ -174,18 +203,21 @@ class Video(object):
         if not self.matched_laps:
             return None
 
-        for lap in self.matched_laps:
-            if lap['start_frame'] <= framenum <= lap['end_frame']:
-                return lap
+        # Laps are in start order, so only the ones starting by framenum
+        # can contain it
+        starts, ends = self.lap_frame_ranges.T
+        count = np.searchsorted(starts, framenum, side='right')
+        hits = np.flatnonzero(ends[:count] >= framenum)
+        if not len(hits):
+            return None
 
-        return None
+        return self.matched_laps[hits[0]]
 
 
     def calibrate_offset(self):
         if not self.matched_laps:
             return 0
 
-        cap = cv2.VideoCapture(self.filenames[0])
         lapinfo = self.matched_laps[0]
         print "#" * 100
         print "# MANUAL OFFSET CALIBRATION "
@@ -204,7 +236,6 @@ class Video(object):
 
         # Set initial frame to calculated start time
         start_framenum = lapinfo['start_frame']
-        cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, start_framenum)
 
         end_calibration = False
         UP_KEY = 65362
@@ -228,87 +259,86 @@ class Video(object):
         from renderers import CalibrationRenderer
 
         renderer = CalibrationRenderer(self)
-        movement = 1
+
+        # Frames come out of a cache that decodes (at preview size) around
+        # the current frame in the background, so moving around doesn't
+        # mean seeking
+        frames = FrameCache(self)
+        frames.start(framenum)
+
         while(not end_calibration):
+            framenum = min(max(framenum, 0), self.frame_count - 1)
             print "Current Frame: %s, sync offset: %s" % (framenum, self.frame_offset)
 
-            if movement != 0 or playing:
-                ret, frame = cap.read()
-
-            if ret:
-                # Find which lap we're in based on framenum
-                lapinfo = self.find_lap_by_framenum(
-                    framenum + self.frame_offset) or self.matched_laps[0]
-                params = RenderParams([], "")
-                lapparams = LapRenderParams(self, lapinfo)
-                params.laps = [lapparams]
-                frame = renderer.render_frame(frame, params, lapparams, framenum, lapinfo['lap'])
-                cv2.imshow('frame', frame)
-                if playing:
-                    wait = 1
-                else:
-                    wait = -1
-
-                keypress = cv2.waitKey(wait)
-                movement = 0
-                print "Keypress: %s" % keypress
-                if keypress == -1:
-                    framenum += 1
-                elif keypress == ENTER:
-                    cap.release()
-                    cv2.destroyAllWindows()
-                    return self.frame_offset
-                elif keypress == SPACE:
-                    playing = not playing
-                elif keypress == UP_KEY:
-                    self.frame_offset += 1
-                    cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, framenum)
-                elif keypress == DOWN_KEY:
-                    self.frame_offset -= 1
-                    cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, framenum)
-                else:
-                    movement = KEY_DELTA.get(keypress, 0)
-
-                print "Moving offset: %s, movemnet: %s" % (self.frame_offset, movement)
-
-                if movement == 1:
-                    # Don't actually seek to get the next frame since seeking is expensive
-                    framenum += 1
-                    continue
-
-                elif movement != 0:
-                    print "Jumping by %s frames..." % movement
-                    framenum += movement
-                    cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, framenum)
-
-
-    def match_laps(self, laps):
-        self.matched_laps = []
+            frame = frames.get(framenum)
+            if frame is None:
+                frame = np.zeros((frames.height, frames.width, 3), dtype=np.uint8)
+            frame = cv2.resize(frame, (self.width, self.height))
+
+            # Find which lap we're in based on framenum
+            lapinfo = self.find_lap_by_framenum(
+                framenum + self.frame_offset) or self.matched_laps[0]
+            params = RenderParams([], "")
+            lapparams = LapRenderParams(self, lapinfo)
+            params.laps = [lapparams]
+            frame = renderer.render_frame(frame, params, lapparams, framenum, lapinfo['lap'])
+            cv2.imshow('frame', frame)
+            if playing:
+                wait = 1
+            else:
+                wait = -1
+
+            keypress = cv2.waitKey(wait)
+            movement = 0
+            print "Keypress: %s" % keypress
+            if keypress == -1:
+                framenum += 1
+            elif keypress == ENTER:
+                frames.stop()
+                cv2.destroyAllWindows()
+                return self.frame_offset
+            elif keypress == SPACE:
+                playing = not playing
+            elif keypress == UP_KEY:
+                self.frame_offset += 1
+            elif keypress == DOWN_KEY:
+                self.frame_offset -= 1
+            else:
+                movement = KEY_DELTA.get(keypress, 0)
+
+            print "Moving offset: %s, movemnet: %s" % (self.frame_offset, movement)
 
-        for lap in laps:
-            self.match_lap(lap)
+            if abs(movement) > 1:
+                print "Jumping by %s frames..." % movement
+            framenum += movement
+
+
+    def set_matched_laps(self, laps):
+        """laps (in start order) all start during this video"""
+        self.matched_laps = [self.match_lap(lap) for lap in laps]
+        self.lap_frame_ranges = np.array(
+            [[lap_info["start_frame"], lap_info["end_frame"]]
+             for lap_info in self.matched_laps], dtype=np.float64).reshape(-1, 2)
 
     def match_lap(self, lap):
-        if self.start_time <= lap.start_time <= self.end_time:
-            start_seconds = (lap.start_time - self.start_time).total_seconds()
-            start_frame = int((start_seconds) * self.fps)
-
-            """
-            print "Lap Start: %s" %  lap.start_time
-            print "Video Start: %s" % self.start_time
-            print "Seconds into video: %s" % start_seconds
-            print "Start Frame: %s" % start_frame
-            """
-
-            end_frame = start_frame + (lap.lap_time * self.fps)
-            lap_info = {
-                "lap": lap,
-                "render": True,
-                "start_seconds": start_seconds,
-                "start_frame": start_frame,
-                "end_frame": end_frame
-            }
-            self.matched_laps.append(lap_info)
+        start_seconds = (lap.start_time - self.start_time).total_seconds()
+        start_frame = int((start_seconds) * self.fps)
+
+        """
+        print "Lap Start: %s" %  lap.start_time
+        print "Video Start: %s" % self.start_time
+        print "Seconds into video: %s" % start_seconds
+        print "Start Frame: %s" % start_frame
+        """
+
+        end_frame = start_frame + (lap.lap_time * self.fps)
+        return {
+            "lap": lap,
+            "render": True,
+            "start_seconds": start_seconds,
+            "start_frame": start_frame,
+            "end_frame": end_frame
+        }
 
     def is_valid(self):
         return self.is_valid_video
@@ -337,6 +367,36 @@ class Video(object):
             len(self.matched_laps)
         )
 
+def match_laps(videos, laps):
+    """
+    Give each video the laps that start while it's recording.  The laps
+    are sorted by start time once and each video's [start, end] window is
+    bisected out of them.
+    """
+    starts = [utils.to_epoch(lap.start_time) for lap in laps]
+    order = sorted(xrange(len(laps)), key=lambda i: starts[i])
+    starts = [starts[i] for i in order]
+    laps = [laps[i] for i in order]
+
+    for video in videos:
+        if not video.end_time:
+            video.set_matched_laps([])
+            continue
+
+        first = bisect.bisect_left(starts, utils.to_epoch(video.start_time))
+        last = bisect.bisect_right(starts, utils.to_epoch(video.end_time))
+        video.set_matched_laps(laps[first:last])
+
+_DATES = {}
+
+def parse_date(text):
+    """dateutil's take on a fix's date column, there are only ever a
+    handful of distinct dates so remember them"""
+    if text not in _DATES:
+        _DATES[text] = parser.parse(text)
+    return _DATES[text]
+
+
 class Day(object):
     pass
 
@@ -344,92 +404,158 @@ class Session(object):
     pass
 
 class Lap(object):
-    def __init__(self, lapnum, fixes):
+    # Everything _calc() derives from the fixes
+    ANALYSIS_ATTRS = ["date", "lap_time", "start_time", "end_time",
+                      "total_distance", "distances",
+                      "speed_markers", "lat_g_markers", "lin_g_markers"]
+
+    # Not a telemetry channel, but interpolates like one
+    DISTANCE = "distance"
+
+    def __init__(self, lapnum, fixes, analysis=None):
+        # Laps are a view over a TelemetryTable, but still accept a plain
+        # list of Fix objects
+        if not isinstance(fixes, TelemetryTable):
+            fixes = TelemetryTable.from_fixes(fixes)
+
         self.lapnum = lapnum
-        self.fixes = fixes
+        self.table = fixes
         self.date = None
         self.speed_markers = []
         self.lat_g_markers = []
         self.lin_g_markers = []
         self.total_distance = 0
-        self.distance_at_fix = {}
-        self._calc()
-
-
-    def get_gps_bounds(self):
-        min_lat = 999
-        min_long = 999
-
-        max_lat = -999
-        max_long = -999
-        for fix in self.fixes:
-            if fix.lat < min_lat:
-                min_lat = fix.lat
-
-            if fix.lat > max_lat:
-                max_lat = fix.lat
+        self.distances = np.zeros(len(fixes))
+        self._times = None
+        self._frame_telemetry = None
+        self._marker_times = {}
+
+        if analysis:
+            # Restored from the telemetry cache, skip the (slow) analysis
+            for attr in self.ANALYSIS_ATTRS:
+                setattr(self, attr, analysis[attr])
+        else:
+            self._calc()
 
-            if fix.long < min_long:
-                min_long = fix.long
+    def analysis(self):
+        return dict([(attr, getattr(self, attr)) for attr in self.ANALYSIS_ATTRS])
 
-            if fix.long > max_long:
-                max_long = fix.long
+    @property
+    def fixes(self):
+        return self.table
 
-        return (min_lat, max_lat, min_long, max_long)
+    def get_gps_bounds(self):
+        lat = self.table.column(Fix.LAT)
+        lon = self.table.column(Fix.LONG)
+        return (lat.min(), lat.max(), lon.min(), lon.max())
+
+    def frame_telemetry(self, fps, lap_start_frame, start_frame, end_frame):
+        """
+        This lap resampled onto video frames, see FrameTelemetry.  The last
+        one asked for is kept, renders and the calibration window keep asking
+        for the same frames.
+        """
+        key = (fps, lap_start_frame, start_frame, end_frame)
+        if self._frame_telemetry is None or self._frame_telemetry.key != key:
+            self._frame_telemetry = FrameTelemetry(self, *key)
+        return self._frame_telemetry
 
     def get_distance_at_time(self, seconds):
-        return self.get_metric_at_time(lambda x: self.distance_at_fix.get(x, 0), seconds)
+        return self.get_metric_at_time(self.DISTANCE, seconds)
 
     def get_mph_at_time(self, seconds):
-        return self.get_metric_at_time(lambda x: x.speed_mph, seconds)
+        return self.get_metric_at_time(Fix.SPEED_MPH, seconds)
 
     def get_lat_g_at_time(self, seconds):
-        return self.get_metric_at_time(lambda x: x.lat_g, seconds)
+        return self.get_metric_at_time(Fix.LAT_G, seconds)
 
     def get_lin_g_at_time(self, seconds):
-        return self.get_metric_at_time(lambda x: x.lin_g, seconds)
+        return self.get_metric_at_time(Fix.LIN_G, seconds)
 
     def get_gps_at_time(self, seconds):
-        return (self.get_metric_at_time(lambda x: x.lat, seconds),
-                self.get_metric_at_time(lambda x: x.long, seconds))
+        return tuple(self.get_metrics_at_time([Fix.LAT, Fix.LONG], seconds))
 
     def get_metric_at_time(self, metric, seconds):
-        # This timestamp should be inbetween two fixes
-        # Find which two, then "interpolate" MPH between them
-
-        if seconds < self.fixes[0].lap_time:
-            return metric(self.fixes[0])
-
-        for i in xrange(len(self.fixes)):
-            if i + 1 >= len(self.fixes):
-                break
-            this_fix = self.fixes[i]
-            next_fix = self.fixes[i+1]
-
-            if this_fix.lap_time <= seconds and next_fix.lap_time >= seconds:
-                total_delta = next_fix.lap_time - this_fix.lap_time
-                this_delta = seconds - this_fix.lap_time
-                if total_delta == 0:
-                    continue
-                percentage = this_delta / total_delta
-                metric_delta = metric(this_fix) - metric(next_fix)
-                metric_delta_mod = -1 * metric_delta * percentage
-                metric_out = metric(this_fix) + metric_delta_mod
-                """
-                print "-" * 100
-                print this_fix.lap_time, metric(this_fix)
-                print next_fix.lap_time, metric(next_fix)
-                print total_delta
-                print seconds
-                print this_delta, percentage
-                print metric_delta, metric_delta_mod, metric_out
-                print "-" * 100
-                """
-                return metric_out
-
-        # Erg, just use the last one?
-        return metric(self.fixes[-1])
-
+        """
+        Value of metric seconds into the lap, interpolated between the two
+        fixes either side of it.  metric is a channel name (or DISTANCE), or
+        a function of a Fix, and seconds can be a number or an array of them
+        """
+        if callable(metric):
+            values = np.array([metric(fix) for fix in self.fixes], dtype=np.float64)
+        else:
+            values = self._channel_values(metric)
+
+        return self._interpolate(values, self._time_lookup(seconds))
+
+    def get_metrics_at_time(self, metrics, seconds):
+        """get_metric_at_time() for several channels, sharing one lookup"""
+        lookup = self._time_lookup(seconds)
+        return [self._interpolate(self._channel_values(metric), lookup)
+                for metric in metrics]
+
+    def _channel_values(self, metric):
+        if metric == self.DISTANCE:
+            return self.distances
+        return self.table.column(metric)
+
+    def _lap_times(self):
+        """lap_time as a float array, and whether it's in order"""
+        if self._times is None:
+            times = np.asarray(self.table.column(Fix.LAP_TIME), dtype=np.float64)
+            self._times = (times, not (np.diff(times) < 0).any())
+        return self._times
+
+    def _time_lookup(self, seconds):
+        """
+        Bracket each of seconds between two fixes.  This finds the same pair
+        the old linear scan did, the first one with
+        lap_time[lo] <= seconds <= lap_time[hi] that isn't zero seconds apart.
+        Anything before the first fix takes the first fix, anything past the
+        end (or with nothing to interpolate between) takes the last.
+        """
+        times, in_order = self._lap_times()
+        scalar = np.ndim(seconds) == 0
+        seconds = np.atleast_1d(np.asarray(seconds, dtype=np.float64))
+        count = len(times)
+        before = seconds < times[0]
+
+        if in_order:
+            left = np.searchsorted(times, seconds, 'left')
+            right = np.searchsorted(times, seconds, 'right')
+            # left == 0 means seconds is the very first lap_time, skip over
+            # any other fixes sharing it
+            lo = np.where(left == 0, right - 1, left - 1)
+            found = lo + 1 < count
+        else:
+            # Some logs jump around in time, bisecting can't find "the
+            # first" pair in those, so check every pair (they're rare)
+            pairs = ((times[:-1] <= seconds[:, np.newaxis]) &
+                     (seconds[:, np.newaxis] <= times[1:]) &
+                     (times[:-1] != times[1:]))
+            found = pairs.any(axis=1)
+            lo = pairs.argmax(axis=1)
+
+        after = ~before & ~found
+        lo = np.clip(lo, 0, count - 1)
+        hi = np.clip(lo + 1, 0, count - 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentage = (seconds - times[lo]) / (times[hi] - times[lo])
+
+        return (lo, hi, percentage, before, after, scalar)
+
+    def _interpolate(self, values, lookup):
+        lo, hi, percentage, before, after, scalar = lookup
+        low = values[lo]
+        with np.errstate(invalid='ignore'):
+            out = low - (low - values[hi]) * percentage
+        out = np.where(before, values[0], out)
+        out = np.where(after, values[-1], out)
+
+        if scalar:
+            return out[0].item()
+        return out
 
     def get_nearest_speed_direction_change(self, seconds, look_forward=False):
         return self.get_nearest_metric_direction_change(self.speed_markers, seconds, look_forward)
@@ -443,115 +569,128 @@ class Lap(object):
     def get_nearest_metric_direction_change(self, markers, seconds, look_forward=False):
         # Find the closest speed change that is _behind_ this fix
         # Unless look_forward=True, then we look _ahead_ of this fix
-
-        # Assumes speed_markers are sorted in time
-        reverse_markers = [m for m in markers]
-        if not look_forward:
-            reverse_markers.reverse()
-        for marker in reverse_markers:
-            this_seconds = marker['seconds']
-            if not look_forward:
-                if this_seconds > seconds:
-                    continue
-                else:
-                    return marker
+        marker_seconds, in_order = self._marker_seconds(markers)
+        if in_order:
+            if look_forward:
+                position = bisect.bisect_left(marker_seconds, seconds)
+                if position == len(markers):
+                    return None
             else:
-                if this_seconds < seconds:
-                    continue
-                else:
-                    return marker
+                position = bisect.bisect_right(marker_seconds, seconds) - 1
+        else:
+            position = int(self.nearest_marker_positions(markers, seconds, look_forward))
 
-        return None
+        if position < 0:
+            return None
+        return markers[position]
+
+    def nearest_marker_positions(self, markers, seconds, look_forward=False):
+        """
+        Where in markers the nearest marker behind (or ahead of) seconds is,
+        -1 if there isn't one.  seconds can be an array, e.g. every frame of
+        a render.
+        """
+        marker_seconds, in_order = self._marker_seconds(markers)
+        marker_seconds = np.array(marker_seconds, dtype=np.float64)
+        seconds = np.asarray(seconds, dtype=np.float64)
+        count = len(marker_seconds)
+
+        if in_order:
+            if look_forward:
+                positions = np.searchsorted(marker_seconds, seconds, 'left')
+                return np.where(positions < count, positions, -1)
+            return np.searchsorted(marker_seconds, seconds, 'right') - 1
+
+        # Markers follow the fixes, so they're only out of order when the
+        # log's lap_time is.  Take the first (or last) match in list order.
+        if look_forward:
+            matches = marker_seconds >= seconds[..., np.newaxis]
+            positions = matches.argmax(axis=-1)
+        else:
+            matches = marker_seconds <= seconds[..., np.newaxis]
+            positions = count - 1 - matches[..., ::-1].argmax(axis=-1)
+        return np.where(matches.any(axis=-1), positions, -1)
+
+    def _marker_seconds(self, markers):
+        """The seconds of each marker, and whether they're sorted"""
+        cached = self._marker_times.get(id(markers))
+        if cached is None or cached[0] is not markers or len(cached[1]) != len(markers):
+            times = [float(m['seconds']) for m in markers]
+            in_order = all(a <= b for a, b in zip(times, times[1:]))
+            # Hang on to markers so its id() can't be reused
+            cached = (markers, times, in_order)
+            self._marker_times[id(markers)] = cached
+        return cached[1], cached[2]
 
     def _calc(self):
-        # find lap length
-        max_time = 0
-        end_time = 0
-        start_time = 0
-        min_time = 999999
-        utc = ""
-        total_distance = 0
-        is_utc = self.fixes[0].is_utc
-        if self.fixes and is_utc:
-            tzname = " UTC"
-        else:
-            tzname = tzlocal.get_localzone()._tzname
-
-        # Peek speed / gforce variables
-        peek_state = {}
-
-        for fix in self.fixes:
-            def peek_metric_calc(state, metric_name, storage_name):
-                last_metric_name = "last_%s" % metric_name
-                last_direction_name = "last_%s_direction" % metric_name
-                last_metric = state.get(last_metric_name, None)
-                last_direction = state.get(last_direction_name, None)
-                last_fix = state.get('last_fix', None)
-
-                cur_metric = getattr(fix, metric_name)
-                cur_direction = None
-
-                if last_metric is not None:
-                    if cur_metric > last_metric:
-                        cur_direction = 1
-                    elif cur_metric < last_metric:
-                        cur_direction = -1
-                    else:
-                        cur_direction = last_direction
-
-                    if (last_direction is not None
-                        and cur_direction is not None
-                        and cur_direction != last_direction):
-
-                        # We've found either a straight vmax or a corner vmin
-                        getattr(self, storage_name).append(
-                            {"metric": last_metric,
-                             "direction": last_direction,
-                             "fix": last_fix,
-                             "seconds": last_fix.lap_time
-                            })
-
-                state[last_direction_name] = cur_direction
-                state[last_metric_name] = cur_metric
-
-            if 'last_fix' in peek_state:
-                peek_metric_calc(peek_state, 'speed_mph', 'speed_markers')
-                peek_metric_calc(peek_state, 'lat_g', 'lat_g_markers')
-                peek_metric_calc(peek_state, 'lin_g', 'lin_g_markers')
-
-                last_fix = peek_state['last_fix']
-                hav = utils.haversine(last_fix.lat,
-                                      last_fix.long,
-                                      fix.lat,
-                                      fix.long)
-
-                total_distance += hav
-                self.distance_at_fix[fix] = total_distance
-
-            if fix.lap_time <= min_time:
-                min_time = fix.lap_time
-                start_time = fix.wall_time
-                self.date = parser.parse(fix.date)
-
-            if fix.lap_time > max_time:
-                max_time = fix.lap_time
-                end_time = fix.wall_time
-
-            peek_state['last_fix'] = fix
-
-        self.total_distance = total_distance
-        self.lap_time = max_time
-        datestr = "%s %s %s" % (fix.date, start_time, tzname)
-        self.start_time = parser.parse(datestr)
-        self.end_time = parser.parse("%s %s %s" % (fix.date, end_time, tzname))
-        if is_utc:
-            self.start_time = self.start_time.astimezone(tzlocal.get_localzone())
-            self.end_time = self.end_time.astimezone(tzlocal.get_localzone())
-        else:
+        table = self.table
+
+        # Cumulative distance, fix to fix.  (haversine() has always been
+        # handed lat/long swapped, keep doing that so distances don't move)
+        lat = table.column(Fix.LAT)
+        lon = table.column(Fix.LONG)
+        steps = utils.haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        self.distances = np.concatenate([[0.0], np.cumsum(steps)])
+        self.total_distance = self.distances[-1].item()
+
+        for metric_name, storage_name in [(Fix.SPEED_MPH, 'speed_markers'),
+                                          (Fix.LAT_G, 'lat_g_markers'),
+                                          (Fix.LIN_G, 'lin_g_markers')]:
+            setattr(self, storage_name, self._direction_changes(table.column(metric_name)))
+
+        # Lap starts at the last fix with the lowest lap_time, ends at the
+        # first with the highest
+        times = table.column(Fix.LAP_TIME)
+        start_fix = end_fix = table[-1]
+        self.lap_time = 0
+        with np.errstate(invalid='ignore'):
+            starts = np.flatnonzero(times <= min(np.nanmin(times), 999999))
+            ends = np.flatnonzero(times > 0)
+        if len(starts):
+            start_fix = table[starts[-1]]
+            self.date = parse_date(start_fix.date)
+        if len(ends):
+            end_fix = table[ends[times[ends].argmax()]]
+            self.lap_time = end_fix.lap_time
+
+        if table.has_column(Fix.TIMESTAMP):
             lz = tzlocal.get_localzone()
-            self.start_time = lz.localize(self.start_time)
-            self.end_time = lz.localize(self.end_time)
-
+            self.start_time = datetime.fromtimestamp(start_fix.timestamp, lz)
+            self.end_time = datetime.fromtimestamp(end_fix.timestamp, lz)
+        else:
+            self.start_time = self._parse_wall_time(start_fix, table[-1].date)
+            self.end_time = self._parse_wall_time(end_fix, table[-1].date)
+
+    def _parse_wall_time(self, fix, date):
+        # For laps without a timestamp column, i.e. built by hand from Fixes
+        if self.table.is_utc:
+            stamp = parser.parse("%s %s UTC" % (date, fix.wall_time))
+            return stamp.astimezone(tzlocal.get_localzone())
+
+        lz = tzlocal.get_localzone()
+        return lz.localize(parser.parse("%s %s" % (date, fix.wall_time)))
+
+    def _direction_changes(self, values):
+        """
+        Markers for every fix where values turns around, e.g. a straight's
+        vmax or a corner's vmin.  A flat (or NaN) step keeps the direction
+        it had, and the first fix of the lap isn't looked at.
+        """
+        steps = np.zeros(len(values), dtype=np.int8)
+        with np.errstate(invalid='ignore'):
+            steps[2:] = (values[2:] > values[1:-1]).astype(np.int8) - (values[2:] < values[1:-1])
+
+        # Carry the last real direction forward over flat steps, 0 = none yet
+        last_step = np.maximum.accumulate(np.where(steps != 0, np.arange(len(steps)), 0))
+        directions = steps[last_step]
+
+        turns = np.flatnonzero((directions[:-1] != 0) & (directions[1:] != directions[:-1]))
+        times = self.table.column(Fix.LAP_TIME)
+        return [{"metric": values[i].item(),
+                 "direction": int(directions[i]),
+                 "fix": self.table[i],
+                 "seconds": times[i].item()}
+                for i in turns]
 
     def details(self):
         return "Lap Length: %s\nLap Start: %s\nLap End: %s\nDistance: %s" % (
@@ -604,15 +743,46 @@ class Fix(object):
     LAT = "lat"
     RPM = "rpm"
     SPEED_KPH = "speed_kph"
+    # Seconds since the epoch, worked out by the parser
+    TIMESTAMP = "timestamp"
     ATTRS = [FIX_ID, FUEL, ALT_FT, ACCEL_SOURCE, HDOP, ODB_KPH, LAP_TIME, MAF, LONG,
              ACCURACY, SATELITES, ALT_M, LIN_G, DATE, LEAN, IAT_C, DISTANCE_MI, GEAR, MAP,
              OIL_C, THROTTLE, SPEED_MPH, LAP_INDEX, HEADING_DEG, COOLANT_C, GPS_FIX_TYPE, LAT_G,
-             GPS_DIFF, DISTANCE_KM, ODB_MPH, WALL_TIME, LAT, RPM, SPEED_KPH]
+             GPS_DIFF, DISTANCE_KM, ODB_MPH, WALL_TIME, LAT, RPM, SPEED_KPH, TIMESTAMP]
+
+    ATTR_SET = frozenset(ATTRS)
 
     DATETIME_ATTRS = [WALL_TIME]
 
-    def __init__(self, is_utc=False):
-        self.is_utc = is_utc
+    __slots__ = ('is_utc', 'table', 'row', '_values')
+
+    def __init__(self, is_utc=False, table=None, row=None):
+        # A Fix is either a standalone bag of values or a lightweight
+        # accessor for one row of a TelemetryTable
+        object.__setattr__(self, 'is_utc', is_utc)
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'row', row)
+        object.__setattr__(self, '_values', {} if table is None else None)
+
+    def __getattr__(self, attr):
+        if attr in Fix.ATTR_SET:
+            if self.table is not None:
+                column = self.table.columns.get(attr)
+                if column is not None:
+                    # Hand back plain python values, not numpy scalars
+                    return column[self.row].item()
+            elif attr in self._values:
+                return self._values[attr]
+
+        raise AttributeError(attr)
+
+    def __setattr__(self, attr, val):
+        if attr not in Fix.ATTR_SET:
+            object.__setattr__(self, attr, val)
+        elif self.table is not None:
+            self.table.column(attr)[self.row] = val
+        else:
+            self._values[attr] = val
 
     def setattr(self, attr, val):
         if attr not in self.ATTRS:
@@ -625,6 +795,12 @@ class Fix(object):
 
         setattr(self, attr, val)
 
+    def attrs(self):
+        if self.table is not None:
+            return self.table.channels()
+
+        return self._values.keys()
+
     def __str__(self):
         return "Fix %s Lap %s @%s %s:%s" % (self.fix_id,
                                              self.lap_index,
@@ -633,13 +809,206 @@ class Fix(object):
                                              self.long)
 
     def copy(self):
-        newfix = Fix()
-        for attr in self.ATTRS:
-            try:
-                setattr(newfix, attr, getattr(self, attr))
-            except:
-                pass
+        newfix = Fix(is_utc=self.is_utc)
+        for attr in self.attrs():
+            setattr(newfix, attr, getattr(self, attr))
 
-        newfix.wall_time = self.wall_time
         newfix.fix_id = "%s b" % newfix.fix_id
         return newfix
+
+
+class TelemetryTable(object):
+    """
+    Columnar storage for a run of GPS fixes: one contiguous numpy array per
+    channel (Fix attribute).  Indexing a table gives Fix row accessors,
+    slicing it gives another table whose columns are views into this one.
+    """
+    STRING_CHANNELS = frozenset([Fix.DATE, Fix.WALL_TIME])
+    INT_CHANNELS = frozenset([Fix.LAP_INDEX])
+
+    def __init__(self, columns, is_utc=False):
+        self.columns = columns
+        self.is_utc = is_utc
+
+        self.size = 0
+        for column in columns.itervalues():
+            self.size = len(column)
+            break
+
+    @classmethod
+    def dtype_for(cls, channel):
+        if channel in cls.STRING_CHANNELS:
+            return np.string_
+        if channel in cls.INT_CHANNELS:
+            return np.int64
+
+        return np.float64
+
+    @classmethod
+    def _to_array(cls, channel, values):
+        dtype = cls.dtype_for(channel)
+        if dtype is np.string_:
+            return np.array(values, dtype=np.string_)
+
+        try:
+            # Let numpy parse the whole column in one go
+            return np.array(values, dtype=dtype)
+        except (ValueError, TypeError):
+            pass
+
+        floats = np.empty(len(values), dtype=np.float64)
+        for index, val in enumerate(values):
+            try:
+                floats[index] = float(val)
+            except (ValueError, TypeError):
+                floats[index] = np.nan
+
+        if dtype is not np.float64:
+            floats = np.nan_to_num(floats)
+
+        return floats.astype(dtype)
+
+    @classmethod
+    def from_text(cls, text_columns, is_utc=False):
+        """Build a table from {channel: [raw csv values]}"""
+        columns = {}
+        for channel, values in text_columns.iteritems():
+            if channel not in Fix.ATTR_SET:
+                raise Exception("Invalid Attr")
+            columns[channel] = cls._to_array(channel, values)
+
+        return cls(columns, is_utc=is_utc)
+
+    @classmethod
+    def from_fixes(cls, fixes, is_utc=None):
+        if is_utc is None:
+            is_utc = bool(fixes) and fixes[0].is_utc
+
+        channels = set()
+        for fix in fixes:
+            channels.update(fix.attrs())
+
+        text_columns = {}
+        for channel in channels:
+            text_columns[channel] = [getattr(fix, channel, None) for fix in fixes]
+
+        return cls.from_text(text_columns, is_utc=is_utc)
+
+    @classmethod
+    def concatenate(cls, tables):
+        if not tables:
+            return cls({})
+
+        columns = {}
+        for channel in tables[0].channels():
+            columns[channel] = np.concatenate(
+                [table.columns[channel] for table in tables])
+
+        return cls(columns, is_utc=tables[0].is_utc)
+
+    def channels(self):
+        return self.columns.keys()
+
+    def column(self, channel):
+        return self.columns[channel]
+
+    def has_column(self, channel):
+        return channel in self.columns
+
+    def slice(self, start, stop):
+        columns = {}
+        for channel, column in self.columns.iteritems():
+            columns[channel] = column[start:stop]
+
+        return TelemetryTable(columns, is_utc=self.is_utc)
+
+    def nbytes(self):
+        return sum([column.nbytes for column in self.columns.itervalues()])
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for row in xrange(self.size):
+            yield Fix(self.is_utc, self, row)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise IndexError("TelemetryTable slices must be contiguous")
+            return self.slice(start, stop)
+
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError("Fix index out of range")
+
+        return Fix(self.is_utc, self, key)
+
+
+class FrameTelemetry(object):
+    """
+    A lap's telemetry resampled onto the frames of a render,
+    start_frame..end_frame (bookends included), so drawing a frame is just
+    indexing arrays instead of interpolating fixes.
+    """
+    CHANNELS = [Fix.SPEED_MPH, Fix.LAT_G, Fix.LIN_G, Fix.LAT, Fix.LONG, Lap.DISTANCE]
+    MARKER_SETS = ["speed_markers", "lat_g_markers", "lin_g_markers"]
+
+    def __init__(self, lap, fps, lap_start_frame, start_frame, end_frame):
+        self.lap = lap
+        self.key = (fps, lap_start_frame, start_frame, end_frame)
+        self.fps = fps
+        self.lap_start_frame = lap_start_frame
+        self.start_frame = start_frame
+
+        count = max(int(math.floor(end_frame - start_frame)) + 1, 0)
+        self.seconds = (start_frame + np.arange(count) - lap_start_frame) / fps
+
+        self.channels = {}
+        if count:
+            values = lap.get_metrics_at_time(self.CHANNELS, self.seconds)
+            self.channels = dict(zip(self.CHANNELS, values))
+
+        # Index of the marker behind each frame, -1 if there isn't one yet
+        self.markers = {}
+        for name in self.MARKER_SETS:
+            self.markers[name] = lap.nearest_marker_positions(getattr(lap, name),
+                                                              self.seconds)
+
+    def __len__(self):
+        return len(self.seconds)
+
+    def index(self, framenum):
+        """Position of framenum in the arrays, None if it's not one of ours"""
+        index = int(round(framenum - self.start_frame))
+        if 0 <= index < len(self.seconds):
+            return index
+        return None
+
+    def seconds_into_lap(self, framenum):
+        return (framenum - self.lap_start_frame) / self.fps
+
+    def values(self, framenum, channels):
+        index = self.index(framenum)
+        if index is None:
+            # e.g. the calibration window playing on past the lap
+            return self.lap.get_metrics_at_time(channels, self.seconds_into_lap(framenum))
+        return [self.channels[channel][index].item() for channel in channels]
+
+    def value(self, framenum, channel):
+        return self.values(framenum, [channel])[0]
+
+    def marker(self, framenum, marker_set):
+        """The marker_set marker nearest behind framenum, or None"""
+        index = self.index(framenum)
+        markers = getattr(self.lap, marker_set)
+        if index is None:
+            return self.lap.get_nearest_metric_direction_change(
+                markers, self.seconds_into_lap(framenum))
+
+        position = self.markers[marker_set][index]
+        if position < 0:
+            return None
+        return markers[position]
@@ -1,13 +1,73 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
 class LaptimeParser(object):
+    # Bump whenever the laps a parser produces change, so cached
+    # telemetry from older versions gets thrown away
+    VERSION = 1
+
     @classmethod
     def is_valid(cls, filename):
+        return cls.matches_header(read_header(filename))
+
+    @classmethod
+    def matches_header(cls, first_line):
         return False
 
+    @classmethod
+    def time_range(cls, filename):
+        """(first, last) fix timestamp in the file as epoch seconds, read
+        cheaply from its head and tail.  None if the parser can't tell."""
+        return None
+
     @classmethod
     def parse_data(cls, datafile):
         raise NotImplemented("Parse needs to implement parse_data()")
 
+    @classmethod
+    def iter_laps(cls, datafile, filename=None):
+        """Yield laps one at a time.  Parsers which can stream their input
+        override this, everything else falls back to parse_data()"""
+        return iter(cls.parse_data(datafile, filename=filename))
+
+
+
+
+def read_header(filename):
+    try:
+        with open(filename) as datafile:
+            return datafile.readline()
+    except IOError:
+        return ""
+
+def read_head_lines(filename, count):
+    lines = []
+    with open(filename) as datafile:
+        for line in datafile:
+            lines.append(line)
+            if len(lines) >= count:
+                break
+
+    return lines
 
+def iter_tail_lines(filename, blocksize=65536):
+    """Non-empty lines from the end of the file, last line first"""
+    with open(filename) as datafile:
+        datafile.seek(0, os.SEEK_END)
+        size = datafile.tell()
+        datafile.seek(max(0, size - blocksize))
+        lines = datafile.read().splitlines()
+
+    # The first line of the block is probably partial
+    if size > blocksize:
+        lines = lines[1:]
+
+    for line in reversed(lines):
+        if line.strip():
+            yield line
 
 
 from harrys_csv import HarrysCSVParser
@@ -15,8 +75,56 @@ from trackaddict_pro import TrackAddictCSVParser
 
 parsers = [HarrysCSVParser, TrackAddictCSVParser]
 
-def find_parser(filename):
+def find_parser(filename, header=None):
+    if header is None:
+        header = read_header(filename)
+
     for parser in parsers:
-        if parser.is_valid(filename):
+        if parser.matches_header(header):
             # Take the first parser that passes
             return parser
+
+def sniff_parsers(filenames):
+    """Pair each file with its parser, reading each header only once.
+    Files no parser recognises are dropped."""
+    found = []
+    for filename in filenames:
+        parser = find_parser(filename)
+        if parser:
+            found.append((filename, parser))
+        else:
+            logger.info("No parser for %s, skipping" % filename)
+
+    return found
+
+
+class CatalogEntry(object):
+    def __init__(self, filename, parser, time_range):
+        self.filename = filename
+        self.parser = parser
+        self.time_range = time_range
+
+    def overlaps(self, start, end):
+        # Files we can't date always have to be parsed
+        if self.time_range is None or start is None or end is None:
+            return True
+
+        return self.time_range[0] <= end and self.time_range[1] >= start
+
+    def __str__(self):
+        return "%s (%s) %s" % (self.filename, self.parser.__name__, self.time_range)
+
+
+def build_catalog(filenames):
+    """Recognised telemetry files with the time span each one covers,
+    without parsing any of them"""
+    catalog = []
+    for filename, parser in sniff_parsers(filenames):
+        try:
+            time_range = parser.time_range(filename)
+        except (IOError, ValueError, IndexError, StopIteration):
+            time_range = None
+
+        catalog.append(CatalogEntry(filename, parser, time_range))
+
+    return catalog
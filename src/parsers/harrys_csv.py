@@ -1,9 +1,60 @@
+import calendar
 import csv
-from StringIO import StringIO
-from . import LaptimeParser
-from models import Fix, Lap
+import numpy as np
+from datetime import datetime
+from . import LaptimeParser, read_head_lines, iter_tail_lines
+from models import Fix, Lap, TelemetryTable
+
+DAY = 24 * 60 * 60
+
+
+class _Clock(object):
+    """
+    Turns Harry's DATE (14-AUG-16) and TIME (16:57:02.65) columns, both UTC,
+    into epoch seconds.  DATE doesn't roll over at midnight, so count how
+    many times TIME has wrapped around under the same DATE.
+    """
+    def __init__(self):
+        self.dates = {}
+        self.last_date = None
+        self.last_seconds = None
+        self.days = 0
+
+    def date_epoch(self, date):
+        if date not in self.dates:
+            try:
+                self.dates[date] = calendar.timegm(
+                    datetime.strptime(date, "%d-%b-%y").timetuple())
+            except ValueError:
+                self.dates[date] = np.nan
+        return self.dates[date]
+
+    @staticmethod
+    def seconds(wall_time):
+        try:
+            hours, minutes, seconds = wall_time.split(":")
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except ValueError:
+            return np.nan
+
+    def timestamps(self, dates, times):
+        stamps = np.empty(len(times), dtype=np.float64)
+        for index, (date, wall_time) in enumerate(zip(dates, times)):
+            seconds = self.seconds(wall_time)
+            if date != self.last_date:
+                self.last_date = date
+                self.days = 0
+            elif seconds < self.last_seconds - DAY / 2:
+                self.days += 1
+
+            self.last_seconds = seconds
+            stamps[index] = self.date_epoch(date) + self.days * DAY + seconds
+
+        return stamps
+
 
 class HarrysCSVParser(LaptimeParser):
+    VERSION = 2
 
     COL_MAPPING = {
         "INDEX": "fix_id",
@@ -44,10 +95,33 @@ class HarrysCSVParser(LaptimeParser):
 
 
     @classmethod
-    def is_valid(cls, filename):
-        df = open(filename)
-        start = df.readline()
-        return "Harry's GPS LapTimer" in start
+    def matches_header(cls, first_line):
+        return "Harry's GPS LapTimer" in first_line
+
+    @classmethod
+    def time_range(cls, filename):
+        _, header, first = read_head_lines(filename, 3)
+        last = next(iter_tail_lines(filename))
+
+        header = next(csv.reader([header]))
+        date_column = header.index("DATE")
+        time_column = header.index("TIME")
+
+        def epoch(line):
+            row = next(csv.reader([line]))
+            stamp = datetime.strptime("%s %s" % (row[date_column], row[time_column]),
+                                      "%d-%b-%y %H:%M:%S.%f")
+            # Harry's logs in UTC
+            return calendar.timegm(stamp.timetuple()) + stamp.microsecond / 1e6
+
+        start = epoch(first)
+        end = epoch(last)
+
+        # Harry's doesn't roll DATE over at midnight (UTC)
+        while end < start:
+            end += DAY
+
+        return (start, end)
 
     @classmethod
     def parse_data(cls, datafile, filename=None):
@@ -56,23 +130,51 @@ class HarrysCSVParser(LaptimeParser):
 INDEX,LAPINDEX,DATE,TIME,TIME_LAP,LATITUDE,LONGITUDE,SPEED_KPH,SPEED_MPH,HEIGHT_M,HEIGHT_FT,HEADING_DEG,GPSDIFFERENTIAL[UNKNOWN/2D3D/DGPS/INVALID],GPSFIX[NOFIX/2D/3D/UNKNOWN],SATELLITES,HDOP,ACCURACY_M,DISTANCE_KM,DISTANCE_MILE,ACCELERATIONSOURCE[CALCULATED/MEASURED/UNDEFINED],LATERALG,LINEALG,LEAN,RPM,MAF,WHEEL_SPEED_KPH,WHEEL_SPEED_MPH,THROTTLE,GEAR,FUEL,COOLANT_CELSIUS,OIL_CELSIUS,IAT_CELSIUS,MAP
 57358,381,14-AUG-16,16:57:02.65,0.000000,34.874742,-118.258734,102.600000,63.752684,740.000000,2427.821526,288.1,2,3,11,0.700000,4.9,0.000000,0.000000,1,0.15,0.34,8.500000,0,0.000000,0.000000,0.000000,0.000000,0,0.000000,0.000000,0.000000,0.000000,0.000000
         """
+        return list(cls.iter_laps(datafile, filename=filename))
+
+    @classmethod
+    def iter_laps(cls, datafile, filename=None):
+        """Stream laps out of the file, yielding each one as soon as its
+        LAPINDEX closes.  Rows are read straight off the file object and
+        mapped by column index, so only one lap worth of rows is in flight"""
         # Fast forward past the Harry's notice
-        data = StringIO("\n".join(datafile.read().split("\n")[1:]))
-        reader = csv.DictReader(data)
-        raw_laps = {}
-        fixes = []
+        datafile.readline()
+        reader = csv.reader(datafile)
+
+        header = next(reader)
+        columns = [(index, cls.COL_MAPPING[name])
+                   for index, name in enumerate(header)
+                   if name in cls.COL_MAPPING]
+        lap_column = header.index("LAPINDEX")
+
+        clock = _Clock()
+
+        lap_key = None
+        rows = []
         for row in reader:
-            fix = Fix(is_utc=True)
-            for k, v in row.iteritems():
-                fix.setattr(cls.COL_MAPPING[k], v)
+            if not row:
+                continue
+
+            if row[lap_column] != lap_key:
+                if rows:
+                    yield cls._build_lap(lap_key, rows, columns, clock)
 
-            fixes.append(fix)
-            lap_fixes = raw_laps.get(fix.lap_index, [])
-            lap_fixes.append(fix)
-            raw_laps[fix.lap_index] = lap_fixes
+                lap_key = row[lap_column]
+                rows = []
 
-        laps = []
-        for lapnum, fixes in raw_laps.iteritems():
-            laps.append(Lap(lapnum, fixes))
+            rows.append(row)
+
+        if rows:
+            yield cls._build_lap(lap_key, rows, columns, clock)
+
+    @classmethod
+    def _build_lap(cls, lap_key, rows, columns, clock):
+        values = zip(*rows)
+        text_columns = {}
+        for index, attr in columns:
+            text_columns[attr] = values[index]
 
-        return laps
+        table = TelemetryTable.from_text(text_columns, is_utc=True)
+        table.columns[Fix.TIMESTAMP] = clock.timestamps(text_columns[Fix.DATE],
+                                                        text_columns[Fix.WALL_TIME])
+        return Lap(float(lap_key), table)
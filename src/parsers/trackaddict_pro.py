@@ -1,11 +1,13 @@
 import csv
+import numpy as np
 import os
-from datetime import datetime, timedelta
-from StringIO import StringIO
-from . import LaptimeParser
-from models import Fix, Lap
+import utils
+from datetime import datetime
+from . import LaptimeParser, iter_tail_lines
+from models import Fix, Lap, TelemetryTable
 
 class TrackAddictCSVParser(LaptimeParser):
+    VERSION = 2
 
     COL_MAPPING = {
         "Time": "lap_time",
@@ -25,10 +27,27 @@ class TrackAddictCSVParser(LaptimeParser):
 
 
     @classmethod
-    def is_valid(cls, filename):
-        df = open(filename)
-        start = df.readline()
-        return "TrackAddict" in start
+    def matches_header(cls, first_line):
+        return "TrackAddict" in first_line
+
+    @classmethod
+    def file_date(cls, filename):
+        # Start date is embedded in the filename only
+        base = os.path.basename(filename)
+        return datetime.strptime(base[4:19], "%Y%m%d-%H%M%S")
+
+    @classmethod
+    def time_range(cls, filename):
+        # TrackAddict logs local time
+        start = utils.to_epoch(cls.file_date(filename))
+        for line in iter_tail_lines(filename):
+            try:
+                return (start, start + float(line.split(',')[0]))
+            except ValueError:
+                # "# Lap" / "# End" markers
+                continue
+
+        return None
 
     @classmethod
     def parse_data(cls, datafile, filename=None):
@@ -41,70 +60,110 @@ class TrackAddictCSVParser(LaptimeParser):
 0.065,0,0,0,0,0.000,34.8708676,-118.2630034,735.5,2413,13.2,303.4,5.0,0.05,0.00,-0.04
         """
 
-        # Start date is embedded in the filename only
-        base = os.path.basename(filename)
-        file_date = datetime.strptime(base[4:19], "%Y%m%d-%H%M%S")
+        file_date = cls.file_date(filename)
 
         # Fast forward past the TrackAddict notice
-        data = StringIO("\n".join(datafile.read().split("\n")[2:]))
-        reader = csv.DictReader(data)
-        raw_laps = {}
-        fixes = []
-        fix_id = 0
+        datafile.readline()
+        datafile.readline()
+        reader = csv.reader(datafile)
+
+        header = next(reader)
+        columns = [(index, cls.COL_MAPPING[name])
+                   for index, name in enumerate(header)
+                   if name in cls.COL_MAPPING]
+        time_column = header.index("Time")
+        lap_column = header.index("Lap")
+
+        # Single pass over the file: keep the data rows, and for every
+        # "# Lap" marker remember when (in session time) the lap ended,
+        # how long it was, which lap it closed and how many rows we had
+        # read when the marker showed up
+        rows = []
+        lap_ends = []
         last_lap_end = 0
-        lap_ended = False
-        last_fix = None
         for row in reader:
-            if "End" in row['Time']:
+            if not row or "End" in row[time_column]:
                 continue
 
-            if "#" in row['Time']:
-                # We need to insert a new fix with the exact lap end time,
-                # then modify all fixes after that time to actually be for the next lap
-
-                laptime = row['Time'][9:].split(':')
+            if "#" in row[time_column]:
+                laptime = row[time_column][9:].split(':')
                 laptime_s = int(laptime[0]) * 3600 + int(laptime[1]) * 60 + float(laptime[2])
                 last_lap_end += laptime_s
-                ending_lap = last_fix.lap_index
-                # Bump all fixes from last lap after laptime_s to next lap
-                fixes = list(raw_laps[last_fix.lap_index])
-                for fix in fixes:
-                    if float(fix.lap_time) > laptime_s:
-                        raw_laps[fix.lap_index].remove(fix)
-
-                        fix.lap_index += 1
-                        if not fix.lap_index in raw_laps:
-                            raw_laps[fix.lap_index] = []
-
-                        fix.lap_time -= last_lap_end
-                        raw_laps[fix.lap_index].insert(0, fix)
-
-                # Now insert the "lap ending" fix into the end of the last lap
-                lapEndFix = raw_laps[last_fix.lap_index][-1].copy()
-                lapEndFix.lap_time = laptime_s
-                raw_laps[ending_lap].append(lapEndFix)
+                lap_ends.append((last_lap_end, laptime_s,
+                                 float(rows[-1][lap_column]), len(rows)))
+                continue
+
+            if len(row) < len(header):
                 continue
 
-            fix = Fix(is_utc=False)
-            for k, v in row.iteritems():
-                if k in cls.COL_MAPPING:
-                    fix.setattr(cls.COL_MAPPING[k], v)
-
-            fix.fix_id = fix_id
-            fix_id += 1
-            fix.lat_g = float(fix.lat_g) * -1
-            fix.lin_g = float(fix.lin_g) * -1
-            fix.date = str(file_date.date())
-            fix.wall_time = str((file_date + timedelta(seconds=fix.lap_time)).time())
-            fix.lap_time -= last_lap_end
-            fixes.append(fix)
-            lap_fixes = raw_laps.get(fix.lap_index, [])
-            lap_fixes.append(fix)
-            raw_laps[fix.lap_index] = lap_fixes
-            last_fix = fix
+            rows.append(row)
+
+        if not rows:
+            return []
+
+        text_columns = {}
+        for index, attr in columns:
+            text_columns[attr] = [row[index] for row in rows]
+
+        raw = TelemetryTable.from_text(text_columns, is_utc=False)
+        session_time = raw.column(Fix.LAP_TIME)
+        num_rows = len(raw)
+
+        raw.columns[Fix.FIX_ID] = np.arange(num_rows, dtype=np.float64)
+        raw.column(Fix.LAT_G)[:] *= -1
+        raw.column(Fix.LIN_G)[:] *= -1
+        raw.columns[Fix.DATE] = np.array([str(file_date.date())] * num_rows)
+        # Session time counts up from the (local) time in the filename
+        raw.columns[Fix.TIMESTAMP] = utils.to_epoch(file_date) + session_time
+
+        # Session time is monotonic, so each lap is a contiguous run of rows
+        # starting with the first fix after the previous lap end
+        boundaries = np.array([end for end, _, _, _ in lap_ends])
+        lap_starts = np.concatenate(([0.0], boundaries))
+        lap_numbers = [float(rows[0][lap_column])] + [
+            ending_lap + 1 for _, _, ending_lap, _ in lap_ends]
+        splits = [0] + list(np.searchsorted(session_time, boundaries, side='right')) + [num_rows]
+
+        row_lap_index = np.empty(num_rows, dtype=np.int64)
+        row_lap_time = np.empty(num_rows, dtype=np.float64)
+        for lap, (start, stop) in enumerate(zip(splits[:-1], splits[1:])):
+            row_lap_index[start:stop] = lap_numbers[lap]
+            row_lap_time[start:stop] = session_time[start:stop] - lap_starts[lap]
+
+        # Every lap that was closed by a marker also gets a "lap ending" fix
+        # with the exact lap time.  It's a copy of the first fix past the
+        # line if we had one when the marker arrived, otherwise of the last
+        # fix we had.
+        take = []
+        lap_end_rows = []
+        bounds = []
+        for lap, (start, stop) in enumerate(zip(splits[:-1], splits[1:])):
+            lap_first = len(take)
+            take.extend(xrange(start, stop))
+
+            if lap < len(lap_ends):
+                _, laptime_s, _, marker_rows = lap_ends[lap]
+                source = stop if stop < marker_rows else marker_rows - 1
+                lap_end_rows.append((len(take), laptime_s))
+                take.append(source)
+
+            bounds.append((lap_first, len(take)))
+
+        take = np.array(take, dtype=np.int64)
+        table_columns = {}
+        for channel, column in raw.columns.iteritems():
+            table_columns[channel] = column[take]
+
+        table_columns[Fix.LAP_INDEX] = row_lap_index[take]
+        table_columns[Fix.LAP_TIME] = row_lap_time[take]
+        for position, laptime_s in lap_end_rows:
+            table_columns[Fix.LAP_TIME][position] = laptime_s
+
+        table = TelemetryTable(table_columns, is_utc=False)
 
         laps = []
-        for lapnum, fixes in raw_laps.iteritems():
-            laps.append(Lap(lapnum, fixes))
+        for lap, (start, stop) in enumerate(bounds):
+            if stop > start:
+                laps.append(Lap(lap_numbers[lap], table.slice(start, stop)))
 
         return laps
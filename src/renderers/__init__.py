@@ -1,17 +1,78 @@
+import copy
 import cv2
+import hashlib
 import logging
 import math
 import os
 import sys
 import tempfile
 import time
-from threading import Thread
+
+import numpy as np
 
 from contextlib import contextmanager
+import seek_index
 import utils
 
+from frame_pool import DEFAULT_BUDGET, FramePool
+from pipeline import FramePipeline
+from sprites import Sprite, moved
+from stages import StageQueue, start_stage
+
 logger = logging.getLogger(__name__)
 
+
+class AlphaLayer(object):
+    """
+    What an alpha() block has drawn on so far, as a rectangle that grows as
+    the drawing helpers report where they're about to draw, and what was
+    under it beforehand.  Only that rectangle gets blended.
+    """
+    def __init__(self, frame, overlay):
+        self.frame = frame
+        self.overlay = overlay
+        self.roi = None
+
+    def cover(self, x0, y0, x1, y1):
+        height, width = self.frame.shape[:2]
+        x0 = min(max(int(x0), 0), width)
+        x1 = min(max(int(math.ceil(x1)), 0), width)
+        y0 = min(max(int(y0), 0), height)
+        y1 = min(max(int(math.ceil(y1)), 0), height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        if self.roi is None:
+            self._save(x0, y0, x1, y1)
+            self.roi = (x0, y0, x1, y1)
+            return
+
+        ox0, oy0, ox1, oy1 = self.roi
+        x0, y0, x1, y1 = min(x0, ox0), min(y0, oy0), max(x1, ox1), max(y1, oy1)
+        if (x0, y0, x1, y1) == self.roi:
+            return
+
+        # Only the new strips around the old rectangle need saving, what's
+        # inside it may have been drawn on already
+        self._save(x0, y0, x1, oy0)
+        self._save(x0, oy1, x1, y1)
+        self._save(x0, oy0, ox0, oy1)
+        self._save(ox1, oy0, x1, oy1)
+        self.roi = (x0, y0, x1, y1)
+
+    def _save(self, x0, y0, x1, y1):
+        if x0 < x1 and y0 < y1:
+            self.overlay[y0:y1, x0:x1] = self.frame[y0:y1, x0:x1]
+
+    def blend(self, alpha):
+        if self.roi is None:
+            return
+
+        x0, y0, x1, y1 = self.roi
+        region = self.frame[y0:y1, x0:x1]
+        cv2.addWeighted(self.overlay[y0:y1, x0:x1], alpha, region, 1 - alpha, 0, region)
+
+
 class BaseRenderer(object):
     def __init__(self, video):
         self.g_meter_size = 200
@@ -24,6 +85,23 @@ class BaseRenderer(object):
 
         self.enable_map = True
 
+        # Scratch copies of the frame for alpha blending, kept between
+        # frames (one per level of nesting) rather than allocated each time
+        self._overlays = []
+        # The alpha() blocks we're in, innermost last
+        self._layers = []
+        # Static overlay elements, see draw_cached()
+        self._sprites = {}
+
+    def __getstate__(self):
+        # Pickled over to the render workers, which make their own scratch
+        # buffers and sprites
+        state = self.__dict__.copy()
+        state["_overlays"] = []
+        state["_layers"] = []
+        state["_sprites"] = {}
+        return state
+
     def generate_metadata(self, args, params):
         tagline = "\nGenerated by Zachs Lap Renderer (github.com/ZachGoldberg/zachsLapRender)"
         return (self.generate_title(args, params), self.generate_description(args) + tagline)
@@ -63,27 +141,105 @@ class BaseRenderer(object):
 
     @contextmanager
     def alpha(self, alpha, frame):
+        """Blends what's drawn inside the block back over what was there
+        before (alpha being how much of that shows through).  Anything drawn
+        on frame in the block has to go through the drawing helpers below,
+        they're what tell the block which part of the frame to blend."""
+        if alpha == 0 or frame is None:
+            yield
+            return
 
-	if alpha != 0:
-            beta = 1 - alpha
-            gamma = 0
-            if frame != None:
-                overlay = frame.copy()
-        yield
-        if alpha != 0 and frame != None:
-            cv2.addWeighted(overlay, alpha, frame, beta, gamma, frame)
+        depth = len(self._layers)
+        if depth == len(self._overlays):
+            self._overlays.append(None)
+
+        overlay = self._overlays[depth]
+        if overlay is None or overlay.shape != frame.shape or overlay.dtype != frame.dtype:
+            overlay = self._overlays[depth] = np.empty_like(frame)
+
+        layer = AlphaLayer(frame, overlay)
+        self._layers.append(layer)
+        try:
+            yield
+        finally:
+            self._layers.pop()
+        layer.blend(alpha)
+
+    def _cover(self, x0, y0, x1, y1, thickness=1):
+        # About to draw within (x0, y0) - (x1, y1), give or take the line
+        # thickness and antialiasing
+        if self._layers:
+            pad = max(thickness, 1) + 2
+            for layer in self._layers:
+                layer.cover(x0 - pad, y0 - pad, x1 + pad + 1, y1 + pad + 1)
+
+    def draw_cached(self, frame, key, draw, extent, thickness=1):
+        """Draws what draw(canvas, offset) would onto frame, from a sprite
+        drawn the first time key comes up (for this frame size).  For
+        anything that looks the same on every frame, drawn with the helpers
+        below.  The canvas only covers extent, (x0, y0, x1, y1) give or take
+        the line thickness (or a function returning it, if that takes some
+        working out), draw has to move its points by offset (moved())."""
+        key = (key, frame.shape)
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            if callable(extent):
+                extent = extent()
+            height, width = frame.shape[:2]
+            pad = max(thickness, 1) + 2
+            x0 = min(max(int(extent[0]) - pad, 0), width)
+            y0 = min(max(int(extent[1]) - pad, 0), height)
+            x1 = min(max(int(math.ceil(extent[2])) + pad + 1, x0), width)
+            y1 = min(max(int(math.ceil(extent[3])) + pad + 1, y0), height)
+            canvas = np.zeros((y1 - y0, x1 - x0, 4), np.uint8)
+            if canvas.size:
+                # The canvas isn't part of any alpha() block we're in
+                layers, self._layers = self._layers, []
+                try:
+                    draw(canvas, (x0, y0))
+                finally:
+                    self._layers = layers
+            sprite = self._sprites[key] = Sprite(canvas, (x0, y0))
+
+        if sprite.width:
+            self._cover(sprite.x, sprite.y,
+                        sprite.x + sprite.width - 1, sprite.y + sprite.height - 1, 0)
+            sprite.composite(frame)
+
+    def _forget_laps(self, laps):
+        # Sprites drawn for a lap (its map) are no use once it's rendered,
+        # and would keep the lap and its telemetry around
+        for key in self._sprites.keys():
+            if any(part is lap for part in key[0] for lap in laps):
+                del self._sprites[key]
+
+    def _color(self, frame, color):
+        # Sprite canvases have an alpha channel, what's drawn on them is opaque
+        if color is not None and frame.shape[2] == 4 and len(color) == 3:
+            return tuple(color) + (255,)
+        return color
 
     def alpha_circle(self, frame, origin, radius, color, thickness=1, lineType=8, shift=0, alpha=0):
-        beta = 1 - alpha
-        gamma = 0
-        overlay = frame.copy()
-        cv2.circle(frame, origin, radius, color, thickness, lineType, shift)
+        self.circle(frame, origin, radius, color, thickness, lineType, shift)
 
     def circle(self, frame, origin, radius, color, thickness=1, lineType=8, shift=0):
-        cv2.circle(frame, origin, radius, color, thickness, lineType, shift)
+        scale = float(1 << shift)
+        self._cover((origin[0] - radius) / scale, (origin[1] - radius) / scale,
+                    (origin[0] + radius) / scale, (origin[1] + radius) / scale, thickness)
+        cv2.circle(frame, origin, radius, self._color(frame, color), thickness, lineType, shift)
+
+    def ellipse(self, frame, center, axes, angle, startAngle, endAngle, color, thickness=1, lineType=8):
+        radius = max(axes)
+        self._cover(center[0] - radius, center[1] - radius,
+                    center[0] + radius, center[1] + radius, thickness)
+        cv2.ellipse(frame, center, axes, angle, startAngle, endAngle, self._color(frame, color),
+                    thickness, lineType)
 
     def line(self, frame, start, fin, color, thickness, lineType=8, shift=0):
-        cv2.line(frame, start, fin, color, thickness, lineType, shift)
+        scale = float(1 << shift)
+        self._cover(min(start[0], fin[0]) / scale, min(start[1], fin[1]) / scale,
+                    max(start[0], fin[0]) / scale, max(start[1], fin[1]) / scale, thickness)
+        cv2.line(frame, start, fin, self._color(frame, color), thickness, lineType, shift)
 
     def text(self, frame, txt, origin,
              font=cv2.FONT_HERSHEY_PLAIN,
@@ -91,42 +247,40 @@ class BaseRenderer(object):
              color=(255, 255, 255),
              stroke=1,
              linetype=cv2.CV_AA):
-        cv2.putText(frame, txt, origin, font, size, color, stroke, linetype)
+        if self._layers:
+            (width, height), baseline = cv2.getTextSize(txt, font, size, stroke)
+            self._cover(origin[0], origin[1] - height,
+                        origin[0] + width, origin[1] + baseline, stroke)
+        cv2.putText(frame, txt, origin, font, size, self._color(frame, color), stroke, linetype)
 
     def alpha_line(self, frame, start, fin, color, thickness, lineType=8, shift=0, alpha=0):
-        beta = 1 - alpha
-        gamma = 0
-        overlay = frame.copy()
-        cv2.line(frame, start, fin, color, thickness, lineType, shift)
-        cv2.addWeighted(overlay, alpha, frame, beta, gamma, frame)
+        with self.alpha(alpha, frame):
+            self.line(frame, start, fin, color, thickness, lineType, shift)
 
     def alpha_text(self, frame, txt, origin, font, size, color, stroke, linetype, alpha):
-        beta = 1 - alpha
-        gamma = 0
-        overlay = frame.copy()
-        cv2.putText(frame, txt, origin, font, size, color, stroke, linetype)
-        cv2.addWeighted(overlay, alpha, frame, beta, gamma, frame)
+        with self.alpha(alpha, frame):
+            self.text(frame, txt, origin, font, size, color, stroke, linetype)
 
 
     def rounded_rectangle(self, frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, fill=False, fillColor=None):
-        if fill:
-            self._rounded_rectangle(frame, topLeft, bottomRight, fillColor, thickness, lineType, cornerRadius, fill, fillColor)
-            self._rounded_rectangle(frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, False)
-        else:
-            self._rounded_rectangle(frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, fill, fillColor)
+        # Panels don't move, so each is drawn once
+        def draw(canvas, offset):
+            top_left, bottom_right = moved(topLeft, offset), moved(bottomRight, offset)
+            if fill:
+                self._rounded_rectangle(canvas, top_left, bottom_right, fillColor, thickness, lineType, cornerRadius, fill, fillColor)
+                self._rounded_rectangle(canvas, top_left, bottom_right, lineColor, thickness, lineType, cornerRadius, False)
+            else:
+                self._rounded_rectangle(canvas, top_left, bottom_right, lineColor, thickness, lineType, cornerRadius, fill, fillColor)
 
+        self.draw_cached(frame, ("rounded_rectangle", tuple(topLeft), tuple(bottomRight), lineColor,
+                                 thickness, lineType, cornerRadius, fill, fillColor), draw,
+                         (topLeft[0], topLeft[1], bottomRight[0], bottomRight[1]), thickness)
 
-    def alpha_rounded_rectangle(self, frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, alpha, fill=False, fillColor=None):
-        beta = 1 - alpha
-        gamma = 0
-        overlay = frame.copy()
-        if fill:
-            self._rounded_rectangle(frame, topLeft, bottomRight, fillColor, thickness, lineType, cornerRadius, fill, fillColor)
-            self._rounded_rectangle(frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, False)
-        else:
-            self._rounded_rectangle(frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, fill, fillColor)
 
-        cv2.addWeighted(overlay, alpha, frame, beta, gamma, frame)
+    def alpha_rounded_rectangle(self, frame, topLeft, bottomRight, lineColor, thickness, lineType, cornerRadius, alpha, fill=False, fillColor=None):
+        with self.alpha(alpha, frame):
+            self.rounded_rectangle(frame, topLeft, bottomRight, lineColor, thickness, lineType,
+                                   cornerRadius, fill, fillColor)
 
 
     """
@@ -141,6 +295,9 @@ class BaseRenderer(object):
         # p1 - p2
         # |     |
         # p4 - p3
+        lineColor = self._color(src, lineColor)
+        fillColor = self._color(src, fillColor)
+
         p1 = topLeft
         p2 = (bottomRight[0], topLeft[1])
         p3 = bottomRight
@@ -199,30 +356,39 @@ class BaseRenderer(object):
                         inner_color,
                         frame_color,
                         inner_line_color, lat_g, lin_g):
-        # Render G force in a circle
-        # Background Circle
-        self.circle(frame, origin, radius, inner_color, -1)
+        # Render G force in a circle, only the ball moves
+        top, bottom = self.from_bottom(2*radius + 35), self.from_bottom(35)
 
-        # Background outline
-        self.circle(frame, origin, radius, frame_color, 1)
+        def draw_dial(canvas, offset):
+            center = moved(origin, offset)
 
-        # Outer Stroke
-        self.circle(frame, origin, int(radius * 0.65), inner_line_color, 1)
+            # Background Circle
+            self.circle(canvas, center, radius, inner_color, -1)
 
-        # Inner Stroke
-        self.circle(frame, origin, int(radius * 0.3), inner_line_color, 1)
+            # Background outline
+            self.circle(canvas, center, radius, frame_color, 1)
 
-        # Crosshairs
-        self.line(frame,
-                  (origin[0], self.from_bottom(2*radius + 35)),
-                  (origin[0], self.from_bottom(35)),
-                  inner_line_color, 1)
+            # Outer Stroke
+            self.circle(canvas, center, int(radius * 0.65), inner_line_color, 1)
 
-        self.line(frame,
-                  (origin[0] - radius, origin[1]),
-                  (origin[0] + radius, origin[1]),
-                  inner_line_color, 1)
+            # Inner Stroke
+            self.circle(canvas, center, int(radius * 0.3), inner_line_color, 1)
+
+            # Crosshairs
+            self.line(canvas,
+                      moved((origin[0], top), offset),
+                      moved((origin[0], bottom), offset),
+                      inner_line_color, 1)
+
+            self.line(canvas,
+                      (center[0] - radius, center[1]),
+                      (center[0] + radius, center[1]),
+                      inner_line_color, 1)
 
+        self.draw_cached(frame, ("g_meter", origin, radius, inner_color, frame_color,
+                                 inner_line_color), draw_dial,
+                         (origin[0] - radius, min(origin[1] - radius, top),
+                          origin[0] + radius, max(origin[1] + radius, bottom)))
 
         self.draw_gforce_ball(frame, origin, lat_g, lin_g)
 
@@ -292,22 +458,34 @@ class BaseRenderer(object):
 
         return gps_origin, map_origin, (lat_scale_factor, long_scale_factor)
 
-    def draw_map(self, frame, start_frame, framenum, lap):
+    def draw_map(self, frame, start_frame, framenum, lap, telemetry=None):
         if not self.enable_map:
             return frame
 
-        gps_origin, map_origin, scales = self._map_data(lap)
+        # The track is the same all lap, only the ball moves
+        def draw_track(canvas, offset):
+            gps_origin, map_origin, scales = self._map_data(lap)
+            color = self._color(canvas, (255,255,255))
+
+            last_fix = lap.fixes[0]
+            for fix in lap.fixes[1:]:
+                cv2.line(canvas,
+                         moved(self._get_map_point(gps_origin, map_origin, scales, last_fix), offset),
+                         moved(self._get_map_point(gps_origin, map_origin, scales, fix), offset),
+                         color, 3, cv2.CV_AA)
 
-        last_fix = lap.fixes[0]
-        for fix in lap.fixes[1:]:
-            cv2.line(frame,
-                     self._get_map_point(gps_origin, map_origin, scales, last_fix),
-                     self._get_map_point(gps_origin, map_origin, scales, fix),
-                     (255,255,255), 3, cv2.CV_AA)
+                last_fix = fix
 
-            last_fix = fix
+        def extent():
+            # Every point lands within half the map's size of its middle
+            gps_origin, map_origin, scales = self._map_data(lap)
+            middle = self._get_map_point(gps_origin, map_origin, scales, None, *gps_origin)
+            return (middle[0] - self.map_width / 2, middle[1] - self.map_height / 2,
+                    middle[0] + self.map_width / 2, middle[1] + self.map_height / 2)
 
-        self.draw_map_ball(frame, start_frame, framenum, lap)
+        self.draw_cached(frame, ("map", lap), draw_track, extent, 3)
+
+        self.draw_map_ball(frame, start_frame, framenum, lap, telemetry=telemetry)
 
     def _get_map_point(self, gps_origin, map_origin, scales, fix=None, lat=None, lon=None):
         if not lat and fix:
@@ -324,15 +502,19 @@ class BaseRenderer(object):
 
         return (int(x), int(y))
 
-    def draw_map_ball(self, frame, start_frame, framenum, lap, ballcolor=(255, 255, 100)):
+    def draw_map_ball(self, frame, start_frame, framenum, lap, ballcolor=(255, 255, 100),
+                      telemetry=None):
         # Now let's draw us!
         gps_origin, map_origin, scales = self._map_data(lap)
 
-        frames_in = framenum - start_frame
-        seconds_total_in = frames_in / self.video.fps
+        if telemetry:
+            (lat, lon) = telemetry.values(framenum, ["lat", "long"])
+        else:
+            frames_in = framenum - start_frame
+            seconds_total_in = frames_in / self.video.fps
+            (lat, lon) = lap.get_gps_at_time(seconds_total_in)
 
-        (lat, lon) = lap.get_gps_at_time(seconds_total_in)
-        cv2.circle(frame, self._get_map_point(gps_origin, map_origin, scales, None, lat, lon), 10, ballcolor, -1)
+        self.circle(frame, self._get_map_point(gps_origin, map_origin, scales, None, lat, lon), 10, ballcolor, -1)
 
     def draw_countdown(self, frame, lapparams, framenum, lap):
         time_before = lapparams.time_before_lap(framenum)
@@ -355,8 +537,16 @@ class BaseRenderer(object):
         y_bottom_coord = int(origin[1] + (radius * math.cos(math.radians(angle + 180))))
 
         # Render G force in a circle
-        # Background Circle
-        self.circle(frame, origin, radius, inner_color, -1)
+        def draw_background(canvas, offset):
+            # Background Circle
+            self.circle(canvas, moved(origin, offset), radius, inner_color, -1)
+
+            # Background outline
+            self.circle(canvas, moved(origin, offset), radius, frame_color, 1)
+
+        self.draw_cached(frame, ("countdown", origin, radius), draw_background,
+                         (origin[0] - radius, origin[1] - radius,
+                          origin[0] + radius, origin[1] + radius))
 
         # Now draw the half circle to make it more clear what's going on
         axes = (radius, radius)
@@ -364,15 +554,16 @@ class BaseRenderer(object):
         startAngle = 0
         endAngle = startAngle - 180
 
-        # Background outline
-        self.circle(frame, origin, radius, frame_color, 1)
-
-
         # http://docs.opencv.org/modules/core/doc/drawing_functions.html#ellipse
-        cv2.ellipse(frame, origin, axes, angle, startAngle, endAngle, (70, 70, 70), -1)
+        self.ellipse(frame, origin, axes, angle, startAngle, endAngle, (70, 70, 70), -1)
 
         # Outer Stroke
-        self.circle(frame, origin, int(radius * 0.65), inner_line_color, 1)
+        stroke_radius = int(radius * 0.65)
+        self.draw_cached(frame, ("countdown_stroke", origin, radius),
+                         lambda canvas, offset: self.circle(canvas, moved(origin, offset),
+                                                            stroke_radius, inner_line_color, 1),
+                         (origin[0] - stroke_radius, origin[1] - stroke_radius,
+                          origin[0] + stroke_radius, origin[1] + stroke_radius))
 
         self.line(frame,
                   (x_top_coord, y_top_coord),
@@ -385,90 +576,160 @@ class BaseRenderer(object):
                   size=6,
                   stroke=4)
 
-    def _render_video_file(self, out, params, show_video=False):
+    def _report_progress(self, params, lapparams, framenum, frames_writen, delta,
+                         last_written_chars):
+        infile = os.path.basename(params.get_video_for_frame(lapparams, framenum))
+
+        if logger.getEffectiveLevel() <= logging.INFO:
+            sys.stdout.write("\b" * last_written_chars)
+            msg = "From %s lap %s, Written %s/%s frames %.2f%% %s fps..." % (
+                infile,
+                int(lapparams.lapinfo['lap'].lapnum),
+                frames_writen,
+                params.total_frames(),
+                100 * float(frames_writen) / params.total_frames(),
+                (30 / delta))
+            sys.stdout.write(msg)
+            last_written_chars = len(msg)
+
+        return last_written_chars
+
+    def _render_video_file(self, out, params, show_video=False, pool=None):
+        if pool is not None and pool.fits((params.height, params.width, 3)):
+            return self._render_video_file_parallel(out, params, show_video, pool)
+
         frames_writen = 0
         last_written_chars = 0
+        # Frames are decoded into these and handed back once written, so
+        # the render thread can only get as far ahead as the budget allows
+        pool = FramePool.for_budget((params.height, params.width, 3), params.frame_memory)
+        logger.debug("Buffering up to %s frames" % len(pool))
         for lapparams in params.laps:
             framenum = lapparams.start_frame
+            # Work out the telemetry for every frame before we start
+            lapparams.telemetry()
             last_time = time.time()
 
-            thread_results = []
-            def render_thread(start):
+            def render_thread(output, start):
                 t_framenum = start
                 while t_framenum <= lapparams.end_frame:
-                    while len(thread_results) > 100:
-                        time.sleep(.1)
-
-                    ret, frame = params.get_framenum(lapparams, t_framenum)
-                    if frame == None:
-                        t_framenum += 1
-                        thread_results.insert(0, None)
-			continue
-
-                    rendered_frame = self.render_frame(frame,
-                                                       params,
-                                                       lapparams,
-                                                       t_framenum,
-                                                       lapparams.lapinfo["lap"])
-                    thread_results.insert(0, rendered_frame)
+                    buf = pool.acquire()
+                    if buf is None:
+                        return
+
+                    ret, frame = params.get_framenum(lapparams, t_framenum, image=buf)
+                    if frame is None:
+                        output.put((buf, None))
+                    else:
+                        output.put((buf, self.render_frame(frame,
+                                                           params,
+                                                           lapparams,
+                                                           t_framenum,
+                                                           lapparams.lapinfo["lap"])))
                     t_framenum += 1
 
-            worker_thread = Thread(target=render_thread, args=(framenum,))
-            worker_thread.start()
+            rendered_frames = StageQueue("render", len(pool))
+            start_stage(render_thread, rendered_frames, framenum)
 
-            while framenum <= lapparams.end_frame:
-                framenum += 1
+            try:
+                for buf, rendered_frame in rendered_frames:
+                    framenum += 1
 
-                while len(thread_results) == 0:
-                    time.sleep(0.1)
+                    if rendered_frame is None:
+                      pool.release(buf)
+                      frames_writen += 1
+                      continue
 
-                rendered_frame = thread_results.pop()
-                if rendered_frame == None:
-                  frames_writen += 1
-                  continue
+                    out.write(rendered_frame)
 
-                out.write(rendered_frame)
+                    if show_video:
+                        cv2.imshow('frame', rendered_frame)
+                        keypress = cv2.waitKey(1)
 
-                if show_video:
-                    cv2.imshow('frame', rendered_frame)
-                    keypress = cv2.waitKey(1)
+                    # Done with it, the buffer can take another frame
+                    rendered_frame = None
+                    pool.release(buf)
+
+                    frames_writen += 1
+                    if frames_writen % 30 == 0:
+                        delta = time.time() - last_time
+                        last_time = time.time()
+
+                        last_written_chars = self._report_progress(
+                            params, lapparams, framenum, frames_writen, delta, last_written_chars)
+            except:
+                pool.cancel()
+                raise
+            finally:
+                rendered_frames.cancel()
+
+            logger.debug(rendered_frames.summary())
+
+        logger.debug("Buttoning up video...")
+        cv2.destroyAllWindows()
+        return True
+
+    def _render_video_file_parallel(self, out, params, show_video, pool):
+        # Work out the telemetry before it's sent over to the workers
+        for lapparams in params.laps:
+            lapparams.telemetry()
 
-                # Assist Garbage collection, throw away the rendered frame
-                rendered_frame = None
+        progress = {"frames_writen": 0, "chars": 0, "last_time": time.time()}
+        def write(lapparams, framenum, frame):
+            progress["frames_writen"] += 1
+            if frame is not None:
+                out.write(frame)
 
-                frames_writen += 1
-                if frames_writen % 30 == 0:
-                    delta = time.time() - last_time
-                    last_time = time.time()
+                if show_video:
+                    cv2.imshow('frame', frame)
+                    keypress = cv2.waitKey(1)
 
-                    infile = os.path.basename(params.get_video_for_frame(lapparams, framenum))
+            if progress["frames_writen"] % 30 == 0:
+                delta = time.time() - progress["last_time"]
+                progress["last_time"] = time.time()
+                progress["chars"] = self._report_progress(
+                    params, lapparams, framenum, progress["frames_writen"], delta,
+                    progress["chars"])
 
-                    if logger.getEffectiveLevel() <= logging.INFO:
-                        sys.stdout.write("\b" * last_written_chars)
-                        msg = "From %s lap %s, Written %s/%s frames %.2f%% %s fps..." % (
-                            infile,
-                            int(lapparams.lapinfo['lap'].lapnum),
-                            frames_writen,
-                            params.total_frames(),
-                            100 * float(frames_writen) / params.total_frames(),
-                            (30 / delta))
-                        sys.stdout.write(msg)
-                        last_written_chars = len(msg)
+        logger.debug("Rendering with %s processes" % pool.workers)
+        FramePipeline(self, params, pool).run(write)
 
         logger.debug("Buttoning up video...")
         cv2.destroyAllWindows()
         return True
 
+    def _check_pipeline(self, params, pool, frames=60):
+        """Renders the start of the first lap both in this process and with
+        the worker pool, True if every frame comes out the same"""
+        lapparams = copy.copy(params.laps[0])
+        lapparams.end_frame = min(lapparams.end_frame, lapparams.start_frame + frames - 1)
+        lapparams.total_frames = lapparams.end_frame - lapparams.start_frame
+        clip = params.sharing_captures()
+        clip.laps = [lapparams]
+
+        single = _FrameDigests()
+        parallel = _FrameDigests()
+        self._render_video_file(single, clip)
+        self._render_video_file(parallel, clip, pool=pool)
+
+        if single.digests != parallel.digests:
+            logger.warning("Render workers' frames differ from rendering in a single process "
+                           "(%s of %s frames match), not using them" % (
+                               len([1 for a, b in zip(single.digests, parallel.digests) if a == b]),
+                               len(single.digests)))
+            return False
+
+        logger.debug("Render workers match rendering in a single process over %s frames" % (
+            len(single.digests)))
+        return True
+
     def _render_audio_file(self, params, newaudiofile):
         logger.debug("Extracting audio...")
         tempfiles = []
         for lap in params.laps:
             outfile = tempfile.NamedTemporaryFile().name
             tempfiles.append(outfile)
-            utils.extract_audio(lap.video.filenames[0],
-                                outfile,
-                                lap.start_time,
-                                lap.duration)
+            lap.video.extract_audio(outfile, lap.start_time, lap.duration)
 
         utils.combine_audio(tempfiles, newaudiofile)
 
@@ -491,12 +752,13 @@ class BaseRenderer(object):
             return RenderParams(laptuples, outputdir)
 
     def render_laps(self, outputdir, show_video=False, bookend_time=0,
-                    render_laps_uniquely=True):
+                    render_laps_uniquely=True, pool=None, frame_memory=DEFAULT_BUDGET):
         params = self._get_render_params(outputdir)
         if not params:
             params = RenderParams([], outputdir)
 
         params.set_render_laps_uniquely(render_laps_uniquely)
+        params.set_frame_memory(frame_memory)
         params.set_bookend_time(bookend_time)
 
         for lap in params.get_videos():
@@ -510,7 +772,16 @@ class BaseRenderer(object):
               fourcc = cv2.cv.CV_FOURCC(*'XVID')
               out = cv2.VideoWriter(params.newfname, fourcc, params.fps, (params.width,
                                                                         params.height))
-              self._render_video_file(out, params, show_video=show_video)
+              if (pool is not None and pool.trusted is None and
+                  pool.fits((params.height, params.width, 3))):
+                  pool.trusted = self._check_pipeline(params, pool)
+              if pool is not None and not pool.trusted:
+                  pool = None
+
+              try:
+                  self._render_video_file(out, params, show_video=show_video, pool=pool)
+              finally:
+                  self._forget_laps([lapparams.lapinfo["lap"] for lapparams in params.laps])
               out.release()
 
               newaudiofile = tempfile.NamedTemporaryFile().name
@@ -530,6 +801,15 @@ class BaseRenderer(object):
 
         params.release()
 
+class _FrameDigests(object):
+    # Stands in for a VideoWriter, keeping a hash of each frame
+    def __init__(self):
+        self.digests = []
+
+    def write(self, frame):
+        self.digests.append(hashlib.sha1(np.ascontiguousarray(frame)).hexdigest())
+
+
 class LapRenderParams(object):
     def __init__(self, video, lapinfo):
         self.video = video
@@ -589,6 +869,13 @@ class LapRenderParams(object):
     def time_before_lap(self, framenum):
         return (self.lap_start_frame - framenum) / self.video.fps
 
+    def telemetry(self):
+        """The lap's telemetry for each of our frames (models.FrameTelemetry)"""
+        return self.lapinfo['lap'].frame_telemetry(self.video.fps,
+                                                   self.lap_start_frame,
+                                                   self.start_frame,
+                                                   self.end_frame)
+
 
 class RenderParams(object):
     def __init__(self, videolaps, outputdir):
@@ -597,6 +884,7 @@ class RenderParams(object):
         self.capstate = {}
         self.render_laps_uniquely = True
         self.enable_info_panel = True
+        self.frame_memory = DEFAULT_BUDGET
         self.outputdir = outputdir
         self.videolaps = videolaps
         for video, _ in videolaps:
@@ -618,9 +906,27 @@ class RenderParams(object):
             self.width = videolaps[0][0].width
             self.height = videolaps[0][0].height
 
+    def __getstate__(self):
+        # The render workers never decode, and captures can't be pickled
+        state = self.__dict__.copy()
+        state["oldcaps"] = {}
+        state["capstate"] = {}
+        return state
+
+    def sharing_captures(self):
+        """A shallow copy that decodes with (and keeps track of) our captures.
+        copy.copy() would go through __getstate__ and leave it none."""
+        params = RenderParams.__new__(RenderParams)
+        params.__dict__.update(self.__dict__)
+        return params
+
     def set_render_laps_uniquely(self, render_laps_uniquely):
         self.render_laps_uniquely = render_laps_uniquely
 
+    def set_frame_memory(self, frame_memory):
+        """Bytes of decoded frames rendering may hold on to at once"""
+        self.frame_memory = frame_memory
+
     def fastest_lap(self):
         fastest_time = self.laps[0].lap_time()
         fastest_lap = self.laps[0]
@@ -680,40 +986,43 @@ class RenderParams(object):
         fileindex = lapparams.video.filename_number(framenum)
         return lapparams.video.filenames[fileindex]
 
-    def get_framenum(self, lapparams, framenum, open_index=0):
+    def get_framenum(self, lapparams, framenum, open_index=0, image=None):
         # Figure out what capture this is
         # Then figure out where we are currently seeked in that capture
         # If it's the next frame, call read.  Otherwise, seek and read
+        # (into image, if there's a buffer for it)
 
         # Figure out which file in that video this is
-        framenum = int(framenum)
-        fileindex = lapparams.video.filename_number(framenum)
+        fileindex, framenum = lapparams.video.locate_frame(int(framenum))
 
         video_fname = self.oldcaps_f[lapparams.video][fileindex]
         video_caps = self.oldcaps[lapparams.video]
         cap_sequence = video_caps[fileindex]
 
-        for i in range(0, fileindex):
-            framenum -= lapparams.video.file_frame_boundaries[i]
-
         while len(cap_sequence) <= open_index:
             cap = cv2.VideoCapture(video_fname)
             cap_sequence.append(cap)
+            # The frame the next read() returns
             self.capstate[cap] = 0
 
         cap = cap_sequence[open_index]
 
-        cap_last_postion = self.capstate[cap]
+        cap_next_position = self.capstate[cap]
+        if framenum != cap_next_position:
+            logger.debug("SEEKING... %s, %s" % (framenum, cap_next_position))
+            seek_index.seek(cap, framenum, cap_next_position,
+                            seek_index.get_index(video_fname))
 
-        if framenum == (cap_last_postion + 1):
-            self.capstate[cap] = framenum
-            return cap.read()
-        else:
-            logger.debug("SEEKING... %s, %s" % (framenum, cap_last_postion))
-            cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, framenum)
-            self.capstate[cap] = framenum
+        self.capstate[cap] = framenum + 1
+        if image is None:
             return cap.read()
 
+        ret, frame = cap.read(image=image)
+        if not ret:
+            # Don't pass on whatever was left in the buffer
+            return ret, None
+        return ret, frame
+
     def release(self):
         for videocaps in self.oldcaps.values():
             for caplist in videocaps:
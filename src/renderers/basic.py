@@ -84,12 +84,8 @@ class BasicRenderer(BaseRenderer):
                         time_since_fade_start = seconds_since_metric - start_fade
 
                         alpha = 1 - (time_since_fade_start / METRIC_APEX_FADE)
-                        beta = 1 - alpha
-                        gamma = 0
-                        overlay = frame.copy()
-                        cv2.putText(overlay, text, render_pos, cv2.FONT_HERSHEY_PLAIN, 4,
-                                    (255, 255, 255), 2, cv2.CV_AA)
-                        cv2.addWeighted(overlay, alpha, frame, beta, gamma, frame)
+                        self.alpha_text(frame, text, render_pos, cv2.FONT_HERSHEY_PLAIN, 4,
+                                        (255, 255, 255), 2, cv2.CV_AA, 1 - alpha)
 
 
         def speed_text(metricinfo):
@@ -6,10 +6,12 @@ import numpy as np
 import os
 import time
 
-from threading import Thread
+from itertools import izip
 
 from renderers import BaseRenderer, RenderParams
-from utils import extract_audio, mix_audiofiles
+from renderers.frame_pool import FramePool
+from renderers.stages import StageQueue, start_stage
+from utils import mix_audiofiles
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -40,6 +42,9 @@ class DualRenderer(BaseRenderer):
         self.map_y = 200
         self.map_x = self.map_width
 
+        # Frames are merged into this, it's written out before the next
+        self._merged = None
+
     def generate_title(self, args, params):
         return "Lap# %s (%s) vs. Lap# %s (%s) at %s" % (
             int(params[0].lapinfo['lap'].lapnum),
@@ -67,10 +72,10 @@ class DualRenderer(BaseRenderer):
 
         logger.debug("Extracting audio...")
         newaudiofile1 = "/tmp/zachaudioout1.wav"
-        extract_audio(self.video1.filenames[0], newaudiofile1, lp1.start_time, lp1.duration)
+        self.video1.extract_audio(newaudiofile1, lp1.start_time, lp1.duration)
 
         newaudiofile2 = "/tmp/zachaudioout2.wav"
-        extract_audio(self.video2.filenames[0], newaudiofile2, lp2.start_time, lp2.duration)
+        self.video2.extract_audio(newaudiofile2, lp2.start_time, lp2.duration)
 
         if lp1.duration > lp2.duration:
             mix_audiofiles(newaudiofile1, newaudiofile2, newaudiofile)
@@ -78,83 +83,96 @@ class DualRenderer(BaseRenderer):
             mix_audiofiles(newaudiofile2, newaudiofile1, newaudiofile)
 
 
-    def _render_video_file(self, out, params, show_video=False):
+    def _render_video_file(self, out, params, show_video=False, pool=None):
+        # The two laps get a thread each, there's no process pool here
         lp1 = params.laps[0]
         lp2 = params.laps[1]
         lp1.set_bookend_time(params.bookend_time)
         lp2.set_bookend_time(params.bookend_time)
+        lp1.telemetry()
+        lp2.telemetry()
 
         params.enable_info_panel = False
 
+        # Both laps move on a frame at a time until both are done
+        framenums = []
         framenum1 = lp1.start_frame
         framenum2 = lp2.start_frame
+        while framenum1 < lp1.end_frame or framenum2 < lp2.end_frame:
+            framenum1 += 1
+            framenum2 += 1
+            framenums.append((framenum1, framenum2))
+
         frames_writen = 0
         total_frames = int(max([lp1.total_frames, lp2.total_frames]))
-        end_frame = max([lp1.end_frame, lp2.end_frame])
 
         last_time = time.time()
 
-        while framenum1 < lp1.end_frame or framenum2 < lp2.end_frame:
-            framenum1 += 1
-            framenum2 += 1
-            frames_writen += 1
-            if frames_writen % 30 == 0:
-                delta = time.time() - last_time
-                last_time = time.time()
-                logger.debug("Written %s/%s frames, %s fps..." % (
-                    frames_writen, total_frames,
-                    (30 / delta)))
-
-            thread1 = None
-            thread2 = None
-            t1val = {}
-            t2val = {}
-            if framenum1 <= lp1.end_frame:
-                ret1, frame1 = params.get_framenum(lp1, framenum1)
-                def render_vid(val):
-                    self.renderer1.render_frame(frame1, params, lp1, framenum1, lp1.lapinfo["lap"])
-                    val['frame'] = frame1
-
-                if frame1 != None:
-                    thread1 = Thread(target=render_vid, args=(t1val, ))
-                    thread1.start()
-            else:
-                # Frame1 will be from the last iteration
-                pass
-
-            if framenum2 <= lp2.end_frame:
-                ret2, frame2 = params.get_framenum(lp2, framenum2, 1)
-                def render_vid2(val):
-                    self.renderer2.render_frame(frame2, params, lp2, framenum2, lp2.lapinfo["lap"])
-                    val['frame'] = frame2
-
-		if frame2 != None:
-                    thread2 = Thread(target=render_vid2, args=(t2val, ))
-                    thread2.start()
-            else:
-                # Frame2 will be from the last iteration
-                pass
-
-            if thread1:
-                thread1.join()
-                frame1 = t1val['frame']
-            if thread2:
-                thread2.join()
-                frame2 = t2val['frame']
-
-            if frame1 != None and frame2 != None:
-                merged_frame = self.merge_frames(frame1, frame2)
-                self.render_frame(merged_frame,
-                              params,
-                              (lp1, lp2),
-                              (framenum1, framenum2),
-                              (lp1.lapinfo['lap'], lp2.lapinfo['lap']))
-
-                out.write(merged_frame)
-
-                if show_video:
-                    cv2.imshow('frame', merged_frame)
-                    keypress = cv2.waitKey(1)
+        # Each lap is decoded and drawn by its own stage, into its own half
+        # of the frame budget, merged and written here
+        pools = [FramePool.for_budget((lp.video.height, lp.video.width, 3),
+                                      params.frame_memory / 2)
+                 for lp in (lp1, lp2)]
+
+        def render_lap(output, renderer, lapparams, which):
+            frame = None
+            for framenum in [pair[which] for pair in framenums]:
+                if framenum > lapparams.end_frame:
+                    # Stick on the last frame of whichever lap is done first.
+                    # Nothing more gets decoded, so its buffer stays as is
+                    output.put((None, frame))
+                    continue
+
+                buf = pools[which].acquire()
+                if buf is None:
+                    return
+
+                ret, frame = params.get_framenum(lapparams, framenum, which, image=buf)
+                if frame is not None:
+                    renderer.render_frame(frame, params, lapparams, framenum,
+                                          lapparams.lapinfo["lap"])
+                output.put((buf, frame))
+
+        stage1 = StageQueue("lap 1", len(pools[0]))
+        stage2 = StageQueue("lap 2", len(pools[1]))
+        start_stage(render_lap, stage1, self.renderer1, lp1, 0)
+        start_stage(render_lap, stage2, self.renderer2, lp2, 1)
+
+        try:
+            for (framenum1, framenum2), (buf1, frame1), (buf2, frame2) in izip(framenums, stage1, stage2):
+                frames_writen += 1
+                if frames_writen % 30 == 0:
+                    delta = time.time() - last_time
+                    last_time = time.time()
+                    logger.debug("Written %s/%s frames, %s fps..." % (
+                        frames_writen, total_frames,
+                        (30 / delta)))
+
+                if frame1 is not None and frame2 is not None:
+                    merged_frame = self.merge_frames(frame1, frame2)
+                    self.render_frame(merged_frame,
+                                  params,
+                                  (lp1, lp2),
+                                  (framenum1, framenum2),
+                                  (lp1.lapinfo['lap'], lp2.lapinfo['lap']))
+
+                    out.write(merged_frame)
+
+                    if show_video:
+                        cv2.imshow('frame', merged_frame)
+                        keypress = cv2.waitKey(1)
+
+                for pool, buf in zip(pools, (buf1, buf2)):
+                    if buf is not None:
+                        pool.release(buf)
+        finally:
+            stage1.cancel()
+            stage2.cancel()
+            for pool in pools:
+                pool.cancel()
+
+        logger.debug(stage1.summary())
+        logger.debug(stage2.summary())
 
         logger.debug("Buttoning up video...")
         params.release()
@@ -175,33 +193,28 @@ class DualRenderer(BaseRenderer):
         color1 = (255, 255, 100)
         color2 = (255, 150, 100)
 
-        start_frame1 = lapparams[0].lap_start_frame
-        start_frame2 = lapparams[1].lap_start_frame
-        frames_in1 = framenums[0] - lapparams[0].lap_start_frame
-        frames_in2 = framenums[1] - lapparams[1].lap_start_frame
-        seconds_in1 = frames_in1 / self.video1.fps
-        seconds_in2 = frames_in2 / self.video2.fps
+        telemetry = [lapparams[0].telemetry(), lapparams[1].telemetry()]
 
-        distance1 = laps[0].get_distance_at_time(seconds_in1)
+        distance1 = telemetry[0].value(framenums[0], "distance")
         t_distance1 = laps[0].total_distance
         dist_perc1 = 100 * (distance1 / t_distance1)
 
-        distance2 = laps[1].get_distance_at_time(seconds_in2)
+        distance2 = telemetry[1].value(framenums[1], "distance")
         t_distance2 = laps[1].total_distance
         dist_perc2 = 100 * (distance2 / t_distance2)
 
 
         with self.alpha(0.5, frame):
-            self.draw_map(frame, starts[0], framenums[0], laps[0])
-            self.draw_map(frame, starts[1], framenums[1], laps[1])
+            self.draw_map(frame, starts[0], framenums[0], laps[0], telemetry[0])
+            self.draw_map(frame, starts[1], framenums[1], laps[1], telemetry[1])
 
             # Draw the leading ball first
             if dist_perc1 > dist_perc2:
-                self.draw_map_ball(frame, starts[1], framenums[1], laps[1], color2)
-                self.draw_map_ball(frame, starts[0], framenums[0], laps[0], color1)
+                self.draw_map_ball(frame, starts[1], framenums[1], laps[1], color2, telemetry[1])
+                self.draw_map_ball(frame, starts[0], framenums[0], laps[0], color1, telemetry[0])
             else:
-                self.draw_map_ball(frame, starts[0], framenums[0], laps[0], color1)
-                self.draw_map_ball(frame, starts[1], framenums[1], laps[1], color2)
+                self.draw_map_ball(frame, starts[0], framenums[0], laps[0], color1, telemetry[0])
+                self.draw_map_ball(frame, starts[1], framenums[1], laps[1], color2, telemetry[1])
 
 
             txt = "%4.2f%%" % (dist_perc1 - dist_perc2)
@@ -227,7 +240,9 @@ class DualRenderer(BaseRenderer):
         height = self.video1.height / 2
         width = self.video1.width
 
-        blank_image = np.zeros((height * 2,width,3), np.uint8)
+        if self._merged is None:
+            self._merged = np.zeros((height * 2,width,3), np.uint8)
+        blank_image = self._merged
 
         top = cv2.resize(frame1, (width, height),
                          interpolation = cv2.INTER_CUBIC)
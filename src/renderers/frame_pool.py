@@ -0,0 +1,60 @@
+"""
+Frame sized buffers allocated up front, as many as fit in a memory budget,
+and handed out and taken back as frames move through rendering.  Frames
+get decoded straight into them, so however long or high resolution the
+video, rendering holds on to the same (bounded) amount of frame memory.
+"""
+
+import logging
+import Queue
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default budget for frames in flight while rendering
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+
+
+def frames_in_budget(shape, budget, minimum=2, dtype=np.uint8):
+    """How many frames of shape fit in budget bytes (at least minimum)"""
+    frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    count = int(budget // frame_bytes)
+    if count < minimum:
+        logger.warning("A %sMB frame budget only fits %s %s frames, using %s" % (
+            budget / (1024 * 1024), count, "x".join(map(str, shape)), minimum))
+        count = minimum
+    return count
+
+
+class FramePool(object):
+    def __init__(self, shape, count, dtype=np.uint8):
+        self.shape = shape
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in xrange(count)]
+        self._free = Queue.Queue()
+        for buf in self.buffers:
+            self._free.put(buf)
+
+    @classmethod
+    def for_budget(cls, shape, budget, minimum=2):
+        return cls(shape, frames_in_budget(shape, budget, minimum))
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def acquire(self):
+        """A free buffer, waiting for one to be released if need be.  None
+        once the pool has been cancelled."""
+        buf = self._free.get()
+        if buf is None:
+            # Wake up anyone else waiting too
+            self._free.put(None)
+        return buf
+
+    def release(self, buf):
+        self._free.put(buf)
+
+    def cancel(self):
+        """Stop handing out buffers, so nothing waits forever on a pool
+        whose consumer has gone away"""
+        self._free.put(None)
@@ -22,12 +22,12 @@ class LikeHarrysRenderer(BaseRenderer):
         minutes_in = int(seconds_total_in / 60)
         seconds_in = seconds_total_in % 60
 
-        # See if we have any vmin/vmax annotations
-        speedinfo = lap.get_nearest_speed_direction_change(
-            seconds_total_in)
+        telemetry = lapparams.telemetry()
 
-        brakeinfo = lap.get_nearest_lin_g_direction_change(seconds_total_in)
-        cornerinfo = lap.get_nearest_lat_g_direction_change(seconds_total_in)
+        # See if we have any vmin/vmax annotations
+        speedinfo = telemetry.marker(framenum, "speed_markers")
+        brakeinfo = telemetry.marker(framenum, "lin_g_markers")
+        cornerinfo = telemetry.marker(framenum, "lat_g_markers")
 
         # How long to show a speed notice for
         METRIC_APEX_DURATION = 3
@@ -88,10 +88,9 @@ class LikeHarrysRenderer(BaseRenderer):
                   cv2.FONT_HERSHEY_PLAIN, 1.5,
                   (255, 255, 255), 1, cv2.CV_AA)
 
-        with self.alpha(0.1, frame):
-            lat_g = lap.get_lat_g_at_time(seconds_total_in)
-            lin_g = lap.get_lin_g_at_time(seconds_total_in)
+        mph, lat_g, lin_g = telemetry.values(framenum, ["speed_mph", "lat_g", "lin_g"])
 
+        with self.alpha(0.1, frame):
             self.render_g_meter(frame,
                                 origin, radius,
                                 (100, 100, 100),
@@ -101,8 +100,6 @@ class LikeHarrysRenderer(BaseRenderer):
                                 lin_g)
 
             # Render MPH
-            # Erg, first figure out MPH
-            mph = lap.get_mph_at_time(seconds_total_in)
             mph_txt = "%3.0f mph" % mph
             g_meter_right_edge = (margin + radius * 2)
             topLeft = [(margin + g_meter_right_edge),
@@ -223,7 +220,7 @@ class LikeHarrysRenderer(BaseRenderer):
                                            METRIC_APEX_FADE, (0, 200))
         """
 
-        self.draw_map(frame, start_frame, framenum, lap)
+        self.draw_map(frame, start_frame, framenum, lap, telemetry=telemetry)
 
         return frame
 
@@ -0,0 +1,253 @@
+"""
+Renders a video's frames with a pool of worker processes, so drawing the
+overlays isn't held up by the GIL.  A thread decodes frames into a ring of
+shared memory slots, the workers draw onto the slots in place, and the
+frames get written out in frame order as they come back.  Only slot
+numbers go through the task queue, the pixels never get pickled.
+
+The workers (and the slots) are forked once, by RenderWorkers, before
+rendering starts any threads of its own: forking while another thread
+holds a lock (logging's, say) can leave the child deadlocked.  What each
+render needs (the renderer, the laps and their telemetry) is pickled over
+to them at the start of it instead.
+"""
+
+import ctypes
+import cPickle as pickle
+import logging
+import multiprocessing
+import os
+import Queue
+import threading
+import traceback
+
+import numpy as np
+
+from threading import Thread
+
+from frame_pool import frames_in_budget
+
+logger = logging.getLogger(__name__)
+
+# How long to wait on the workers to finish off a failed render's frames
+DRAIN_TIMEOUT = 30
+
+
+def can_fork():
+    # The workers rely on inheriting the shared memory slots
+    return hasattr(os, "fork")
+
+
+def _slot_frames(buf, slot_bytes, slots, shape):
+    # The slots as frames of shape (which may not fill them)
+    return np.ndarray((slots,) + shape, dtype=np.uint8, buffer=buf,
+                      strides=(slot_bytes, shape[1] * shape[2], shape[2], 1))
+
+
+def _overlay_worker(buf, slot_bytes, slots, jobs, tasks, done):
+    job_id = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        task_job, seq, slot, lap_index, framenum = task
+        try:
+            # Everything for a render is queued up for every worker before
+            # its first frame, older ones just get skipped over
+            while job_id != task_job:
+                job_id, renderer, params, shape = pickle.loads(jobs.get())
+                frames = _slot_frames(buf, slot_bytes, slots, shape)
+
+            lapparams = params.laps[lap_index]
+            frame = frames[slot]
+            rendered = renderer.render_frame(frame, params, lapparams, framenum,
+                                             lapparams.lapinfo["lap"])
+            if rendered is not None and rendered is not frame:
+                frame[...] = rendered
+            done.put((task_job, seq, slot, rendered is not None, None))
+        except Exception:
+            done.put((task_job, seq, slot, False, traceback.format_exc()))
+
+
+class RenderWorkers(object):
+    def __init__(self, workers, slot_bytes, slots):
+        self.workers = workers
+        self.slot_bytes = slot_bytes
+        self.slots = slots
+        # Set once the pipeline's been checked against rendering in-process
+        self.trusted = None
+        self.broken = False
+
+        others = [thread.name for thread in threading.enumerate()
+                  if thread is not threading.current_thread()]
+        if others:
+            logger.warning("Forking render workers with other threads running: %s" % (
+                ", ".join(others)))
+
+        self.buffer = multiprocessing.RawArray(ctypes.c_uint8, slots * slot_bytes)
+        self.tasks = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        self.jobs = [multiprocessing.Queue() for _ in xrange(workers)]
+        self._job_id = 0
+
+        self.processes = [multiprocessing.Process(target=_overlay_worker,
+                                                  args=(self.buffer, slot_bytes, slots,
+                                                        jobs, self.tasks, self.done))
+                          for jobs in self.jobs]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+    @classmethod
+    def for_videos(cls, videos, workers, budget):
+        """Workers with slots big enough for any of videos' frames, as many
+        as fit in budget bytes (but at least one per worker plus one)"""
+        if not can_fork():
+            logger.warning("Can't fork here, rendering in a single process")
+            return None
+
+        shape = max([(video.height, video.width, 3) for video in videos],
+                    key=lambda shape: shape[0] * shape[1])
+        slots = frames_in_budget(shape, budget, workers + 1)
+        logger.debug("Starting %s render workers, %s frame slots" % (workers, slots))
+        return cls(workers, shape[0] * shape[1] * shape[2], slots)
+
+    def fits(self, shape):
+        return not self.broken and shape[0] * shape[1] * shape[2] <= self.slot_bytes
+
+    def frames(self, shape):
+        return _slot_frames(self.buffer, self.slot_bytes, self.slots, shape)
+
+    def start_job(self, renderer, params, shape):
+        """Hands the workers what they need to render frames for params,
+        returns the id their tasks have to carry"""
+        self._job_id += 1
+        job = pickle.dumps((self._job_id, renderer, params, shape), pickle.HIGHEST_PROTOCOL)
+        for jobs in self.jobs:
+            jobs.put(job)
+        return self._job_id
+
+    def close(self):
+        for process in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+
+class FramePipeline(object):
+    def __init__(self, renderer, params, pool):
+        self.renderer = renderer
+        self.params = params
+        self.pool = pool
+
+    def frames(self):
+        """(lap index, frame number) of every frame to render, in order"""
+        for lap_index, lapparams in enumerate(self.params.laps):
+            framenum = lapparams.start_frame
+            while framenum <= lapparams.end_frame:
+                yield lap_index, framenum
+                framenum += 1
+
+    def run(self, write):
+        """Render every frame, calling write(lapparams, framenum, frame) for
+        each in order (from this thread).  Frames that couldn't be decoded
+        or rendered are passed as None."""
+        params = self.params
+        pool = self.pool
+        shape = (params.height, params.width, 3)
+        frames = pool.frames(shape)
+        job_id = pool.start_job(self.renderer, params, shape)
+        tasks = pool.tasks
+        done = pool.done
+
+        free = Queue.Queue()
+        for slot in xrange(pool.slots):
+            free.put(slot)
+
+        jobs = list(self.frames())
+        decode_errors = []
+        stopped = []
+        # Frames handed to the workers and not back yet
+        outstanding = [0]
+        lock = threading.Lock()
+
+        def decode():
+            try:
+                for seq, (lap_index, framenum) in enumerate(jobs):
+                    if stopped:
+                        return
+                    slot = free.get()
+                    if slot is None:
+                        return
+
+                    # Decoded straight into the slot, unless OpenCV had to
+                    # allocate a frame of its own
+                    ret, frame = params.get_framenum(params.laps[lap_index], framenum,
+                                                     image=frames[slot])
+                    if frame is None or frame.shape != shape:
+                        free.put(slot)
+                        done.put((job_id, seq, None, False, None))
+                        continue
+
+                    if not np.may_share_memory(frame, frames[slot]):
+                        frames[slot][...] = frame
+                    with lock:
+                        outstanding[0] += 1
+                    tasks.put((job_id, seq, slot, lap_index, framenum))
+            except Exception:
+                decode_errors.append(traceback.format_exc())
+                done.put((job_id, None, None, False, None))
+
+        decoder = Thread(target=decode)
+        decoder.daemon = True
+        decoder.start()
+
+        def result():
+            while True:
+                task_job, seq, slot, ok, error = done.get()
+                if slot is not None:
+                    with lock:
+                        outstanding[0] -= 1
+                # Anything left over from an earlier (failed) render
+                if task_job == job_id:
+                    return seq, slot, ok, error
+
+        # Frames come back in whatever order the workers finish them
+        finished = {}
+        try:
+            for seq in xrange(len(jobs)):
+                while seq not in finished:
+                    done_seq, slot, ok, error = result()
+                    if error or decode_errors:
+                        raise RuntimeError("Rendering failed:\n%s" % (
+                            error or decode_errors[0]))
+                    finished[done_seq] = (slot, ok)
+
+                slot, ok = finished.pop(seq)
+                lap_index, framenum = jobs[seq]
+                write(params.laps[lap_index], framenum,
+                      frames[slot] if ok else None)
+                if slot is not None:
+                    free.put(slot)
+        finally:
+            stopped.append(True)
+            free.put(None)
+            decoder.join()
+            self._drain(outstanding)
+
+    def _drain(self, outstanding):
+        # The workers outlive this render, so make sure nothing of it is
+        # still drawing on a slot (or left in the queue) when the next
+        # starts.  If they're stuck, they're no use any more.
+        while outstanding[0] > 0:
+            try:
+                task_job, seq, slot, ok, error = self.pool.done.get(timeout=DRAIN_TIMEOUT)
+            except Queue.Empty:
+                logger.error("Render workers stopped responding, not using them again")
+                self.pool.broken = True
+                return
+            if slot is not None:
+                outstanding[0] -= 1
@@ -0,0 +1,45 @@
+"""
+Overlay elements that look the same on every frame (the map outline, the
+g-meter's dial, panel backgrounds) drawn once as sprites and stamped onto
+each frame rather than redrawn.  They're drawn with the usual cv2 calls
+onto a transparent BGRA canvas, where antialiasing blends the alpha channel
+just like the colour, so the canvas ends up premultiplied: exactly what
+drawing onto a frame would have blended in.  The canvas only covers the
+element's extent, so what's drawn on it is moved by the canvas's offset
+into the frame.
+"""
+
+import numpy as np
+
+
+def moved(point, offset):
+    """point (in frame coordinates) on a canvas at offset in the frame"""
+    return (point[0] - offset[0], point[1] - offset[1])
+
+
+class Sprite(object):
+    def __init__(self, canvas, offset=(0, 0)):
+        """Crops a drawn on BGRA canvas (at offset in the frame) down to
+        what was drawn"""
+        rows = np.flatnonzero(canvas[:, :, 3].any(axis=1))
+        cols = np.flatnonzero(canvas[:, :, 3].any(axis=0))
+        if not len(rows):
+            self.x = self.y = self.width = self.height = 0
+            return
+
+        self.width = int(cols[-1]) + 1 - int(cols[0])
+        self.height = int(rows[-1]) + 1 - int(rows[0])
+        crop = canvas[rows[0]:rows[0] + self.height, cols[0]:cols[0] + self.width]
+        self.x, self.y = offset[0] + int(cols[0]), offset[1] + int(rows[0])
+
+        # frame * (255 - alpha) + colour * 255 can't pass 255 * 255, so the
+        # blend fits in 16 bits
+        self.premultiplied = crop[:, :, :3].astype(np.uint16) * 255 + 127
+        self.inverse = 255 - crop[:, :, 3:].astype(np.uint16)
+
+    def composite(self, frame):
+        if not self.width:
+            return
+
+        region = frame[self.y:self.y + self.height, self.x:self.x + self.width]
+        region[...] = (region * self.inverse + self.premultiplied) // 255
@@ -0,0 +1,113 @@
+"""
+Handing frames from one rendering stage (a thread) to the next.  A
+StageQueue is a bounded queue: a producer that gets too far ahead blocks
+until there's room, and a consumer blocks until there's something to take,
+rather than either of them polling.  Closing it (or an exception in the
+producer) ends the consumer's iteration, the exception being re-raised
+there.  Each queue keeps track of how long both ends spent waiting and how
+deep it got, see summary().
+"""
+
+import logging
+import Queue
+import sys
+import time
+
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+_ITEM, _DONE, _ERROR = range(3)
+
+
+class StageCancelled(Exception):
+    """Raised in a producer whose consumer has gone away"""
+
+
+class StageQueue(object):
+    def __init__(self, name, maxsize=0):
+        self.name = name
+        self.maxsize = maxsize
+        self.cancelled = False
+
+        self.items = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+
+        self._queue = Queue.Queue(maxsize)
+
+    def put(self, item):
+        """Hand item on, waiting while the queue is full"""
+        if self.cancelled:
+            raise StageCancelled(self.name)
+
+        start = time.time()
+        self._queue.put((_ITEM, item))
+        self.put_wait += time.time() - start
+
+        depth = self._queue.qsize()
+        self.items += 1
+        self._depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def close(self):
+        """Nothing more is coming"""
+        self._queue.put((_DONE, None))
+
+    def fail(self):
+        """Pass the exception being handled on to the consumer"""
+        self._queue.put((_ERROR, sys.exc_info()))
+
+    def cancel(self):
+        """Called by the consumer when it's giving up, so a producer
+        waiting on a full queue doesn't wait forever"""
+        self.cancelled = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def __iter__(self):
+        while True:
+            start = time.time()
+            kind, item = self._queue.get()
+            self.get_wait += time.time() - start
+
+            if kind == _DONE:
+                return
+            elif kind == _ERROR:
+                raise item[0], item[1], item[2]
+
+            yield item
+
+    def summary(self):
+        return "%s: %s items, producer waited %.2fs, consumer waited %.2fs, depth %.1f avg / %s max (of %s)" % (
+            self.name,
+            self.items,
+            self.put_wait,
+            self.get_wait,
+            float(self._depth_total) / max(self.items, 1),
+            self.max_depth,
+            self.maxsize or "unbounded")
+
+
+def start_stage(target, output, *args):
+    """Run target(output, *args) in a thread that feeds output, closing
+    output when target returns (or failing it if target raises)"""
+    def run():
+        try:
+            target(output, *args)
+        except StageCancelled:
+            pass
+        except Exception:
+            output.fail()
+        else:
+            output.close()
+
+    thread = Thread(target=run, name=output.name)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,113 @@
+"""
+Compares seeking with OpenCV's own frame seek against seek_index's
+keyframe seek on a video file: how long each seek takes and how often it
+lands on the frame asked for.  The right answer for each frame comes from
+decoding the start of the file sequentially first.
+
+    python seek_benchmark.py GOPR0001.MP4 --frames 3000 --seeks 100
+"""
+
+import argparse
+import cv2
+import hashlib
+import random
+import sys
+import time
+
+import numpy as np
+
+import seek_index
+
+
+def fingerprint(frame):
+    small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (32, 18),
+                       interpolation=cv2.INTER_AREA)
+    return hashlib.sha1(small.tostring()).hexdigest()
+
+
+def reference_frames(filename, frames):
+    cap = cv2.VideoCapture(filename)
+    prints = []
+    while len(prints) < frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        prints.append(fingerprint(frame))
+    cap.release()
+    return prints
+
+
+def frame_error(prints, target, found, search=60):
+    # How far off the frame that came back is (None if it's not nearby)
+    if prints[target] == found:
+        return 0
+
+    for distance in xrange(1, search + 1):
+        for framenum in (target - distance, target + distance):
+            if 0 <= framenum < len(prints) and prints[framenum] == found:
+                return framenum - target
+
+    return None
+
+
+def run(filename, targets, prints, index=None):
+    cap = cv2.VideoCapture(filename)
+    latencies = []
+    errors = []
+    for target in targets:
+        start = time.time()
+        if index is None:
+            cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, target)
+        else:
+            # Position unknown, like a fresh capture, so it always seeks
+            seek_index.seek(cap, target, None, index)
+        ret, frame = cap.read()
+        latencies.append(time.time() - start)
+        errors.append(frame_error(prints, target, fingerprint(frame)) if ret else None)
+    cap.release()
+    return np.array(latencies), errors
+
+
+def report(name, latencies, errors):
+    exact = len([e for e in errors if e == 0])
+    lost = len([e for e in errors if e is None])
+    off = [abs(e) for e in errors if e]
+    print "%-10s median %6.1fms  p95 %6.1fms  max %6.1fms  exact %s/%s  worst miss %s  lost %s" % (
+        name,
+        1000 * np.median(latencies),
+        1000 * np.percentile(latencies, 95),
+        1000 * latencies.max(),
+        exact, len(errors),
+        max(off) if off else 0,
+        lost)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark frame seeking")
+    parser.add_argument("filename")
+    parser.add_argument("--frames", type=int, default=3000,
+                        help="How much of the file to check (default: 3000 frames)")
+    parser.add_argument("--seeks", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.time()
+    index = seek_index.get_index(args.filename)
+    if index is None:
+        print "Unable to index %s (is ffprobe installed?)" % args.filename
+        sys.exit(1)
+    print "Index: %s frames, %s keyframes (%.2fs)" % (
+        len(index), len(index.keyframes), time.time() - start)
+
+    prints = reference_frames(args.filename, args.frames)
+    print "Decoded %s reference frames" % len(prints)
+
+    random.seed(args.seed)
+    targets = [random.randrange(len(prints)) for _ in xrange(args.seeks)]
+
+    report("opencv", *run(args.filename, targets, prints))
+    report("keyframe", *run(args.filename, targets, prints, index))
+
+
+if __name__ == '__main__':
+    main()
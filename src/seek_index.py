@@ -0,0 +1,192 @@
+"""
+Per-file index of frame timestamps and keyframes, for seeking.  Asking
+OpenCV to seek straight to a frame is slow on long-GOP footage and can
+land a few frames out, so with an index a seek goes to the keyframe at or
+before the target, by its presentation time, checks where it actually
+landed and decodes forward from there, counting frames itself.  Indexes
+come from one ffprobe pass over the file's packets, nothing gets decoded,
+and are kept in the video store.  They're built up front, by
+index_videos(), for the videos that are going to be rendered.
+"""
+
+import bisect
+import cv2
+import logging
+import subprocess
+
+import numpy as np
+
+import utils
+import video_store
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# Reading forward through this many frames beats seeking
+MAX_SKIP = 90
+
+# Keyframes to try (each one earlier) before leaving a seek to OpenCV
+SEEK_ATTEMPTS = 3
+
+_indexes = {}
+
+
+class FrameIndex(object):
+    def __init__(self, pts, keyframes):
+        # Presentation time (seconds) of every frame, in frame order
+        self.pts = pts
+        # Frame numbers of the keyframes, ascending
+        self.keyframes = keyframes
+        self._keyframe_list = [int(k) for k in keyframes]
+        # OpenCV's timestamps count from the first frame
+        self.start = float(pts[0]) if len(pts) else 0.0
+        # Half a frame's slack when matching a timestamp to a frame
+        self._slack = float(np.median(np.diff(pts))) / 2 if len(pts) > 1 else 0.0
+
+    def __len__(self):
+        return len(self.pts)
+
+    def keyframe_before(self, framenum):
+        """The last keyframe at or before framenum"""
+        position = bisect.bisect_right(self._keyframe_list, framenum)
+        if not position:
+            return 0
+        return self._keyframe_list[position - 1]
+
+    def time_of(self, framenum):
+        """Seconds from the first frame to framenum"""
+        return float(self.pts[framenum]) - self.start
+
+    def frame_at(self, seconds):
+        """Number of the frame showing at seconds from the first frame"""
+        return max(int(np.searchsorted(self.pts, self.start + seconds + self._slack,
+                                       side='right')) - 1, 0)
+
+
+def scan(filename):
+    """
+    FrameIndex for filename from its video packets (ffprobe reads them
+    without decoding anything), or None if ffprobe isn't around or the
+    file has no video.  Packets come in decode order, frames are numbered
+    in presentation order.
+    """
+    cmnd = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', filename]
+    try:
+        p = subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+
+    out, _ = p.communicate()
+    pts = []
+    is_key = []
+    for line in out.splitlines():
+        fields = line.strip().split(",")
+        try:
+            pts.append(float(fields[0]))
+        except ValueError:
+            continue
+        is_key.append("K" in fields[-1])
+
+    if not pts:
+        return None
+
+    pts = np.array(pts, dtype=np.float64)
+    order = np.argsort(pts, kind='mergesort')
+    framenums = np.empty(len(order), dtype=np.int64)
+    framenums[order] = np.arange(len(order))
+    keyframes = np.sort(framenums[np.array(is_key, dtype=bool)])
+
+    return FrameIndex(pts[order], keyframes)
+
+
+def get_index(filename):
+    """FrameIndex for filename, from the video store or scanned (and
+    stored) the first time it's needed.  None without ffprobe."""
+    if filename in _indexes:
+        return _indexes[filename]
+
+    index = None
+    stored = video_store.lookup_frame_index(filename)
+    if stored is not None:
+        index = FrameIndex(np.frombuffer(stored[0], dtype=np.float64),
+                           np.frombuffer(stored[1], dtype=np.int64))
+    else:
+        logger.info("Indexing frames of %s..." % filename)
+        index = scan(filename)
+        if index is not None:
+            video_store.record_frame_index(filename,
+                                           index.pts.astype(np.float64).tostring(),
+                                           index.keyframes.astype(np.int64).tostring())
+
+    _indexes[filename] = index
+    return index
+
+
+def index_videos(filenames, workers=utils.PROBE_WORKERS):
+    """Get the indexes for filenames ready, a few at a time, rather than
+    scanning each in the middle of its first seek"""
+    filenames = [filename for filename in filenames if filename not in _indexes]
+    if not filenames:
+        return
+
+    logger.info("Loading frame indexes for %s video files..." % len(filenames))
+    pool = ThreadPool(max(1, min(workers, len(filenames))))
+    try:
+        pool.map(get_index, filenames)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _seek_keyframe(cap, framenum, keyframe, index):
+    """
+    Seek cap to keyframe by its presentation time, and read the frame it
+    lands on to see which one that is.  If that's already past framenum,
+    try the keyframe before.  Returns the frame the next read() returns,
+    or None if it couldn't be got to land at or before framenum.
+    """
+    for _ in xrange(SEEK_ATTEMPTS):
+        cap.set(cv2.cv.CV_CAP_PROP_POS_MSEC, index.time_of(keyframe) * 1000)
+        if not cap.grab():
+            return None
+
+        landed = index.frame_at(cap.get(cv2.cv.CV_CAP_PROP_POS_MSEC) / 1000.0)
+        if landed < framenum:
+            return landed + 1
+
+        logger.debug("Seeking to keyframe %s (for frame %s) landed on frame %s" % (
+            keyframe, framenum, landed))
+        if not keyframe:
+            return None
+        keyframe = index.keyframe_before(keyframe - 1)
+
+    return None
+
+
+def seek(cap, framenum, position=None, index=None, max_skip=MAX_SKIP):
+    """
+    Get cap ready for its next read() to return framenum.  position is the
+    frame read() would return now, if it's known.  Short hops forward (or
+    ones that wouldn't get past another keyframe) just read on, other than
+    that seeks go to the keyframe before framenum when there's an index and
+    are left to OpenCV when there isn't (or they can't be made to land).
+    """
+    keyframe = index.keyframe_before(framenum) if index is not None else None
+
+    if position is not None and position <= framenum and (
+            framenum - position <= max_skip or
+            (keyframe is not None and keyframe <= position)):
+        start = position
+    elif keyframe is None:
+        cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, framenum)
+        return
+    else:
+        start = _seek_keyframe(cap, framenum, keyframe, index)
+        if start is None:
+            cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, framenum)
+            return
+
+    for _ in xrange(framenum - start):
+        cap.grab()
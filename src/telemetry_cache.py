@@ -0,0 +1,209 @@
+"""
+Parsed telemetry, cached on disk so reruns don't have to go through csv +
+float() again.  Every source file gets its own directory holding one .npy
+per channel (memory mapped on load), the lap boundaries and everything
+Lap._calc() works out, plus a meta.json with the identity of the source
+file it was built from.  A different size, mtime or parser version means
+the entry is stale and gets rebuilt.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tzlocal
+
+import numpy as np
+
+from datetime import datetime
+
+import utils
+from models import Lap, TelemetryTable
+
+logger = logging.getLogger(__name__)
+
+# Bump when the on-disk layout or the cached Lap analysis changes
+FORMAT_VERSION = 1
+
+MARKER_SETS = ["speed_markers", "lat_g_markers", "lin_g_markers"]
+
+# Columns of laps.npy
+LAP_FIELDS = ["lapnum", "start", "stop", "lap_time", "start_time",
+              "end_time", "date", "total_distance"]
+
+DISTANCE_COLUMN = "distance"
+
+
+def _entry_path(filename):
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(utils.cache_dir("telemetry"), key)
+
+
+def _identity(filename, parserClass):
+    res = os.stat(filename)
+    return {
+        "source": os.path.abspath(filename),
+        "size": res.st_size,
+        "mtime": res.st_mtime,
+        "parser": parserClass.__name__,
+        "parser_version": parserClass.VERSION,
+        "format_version": FORMAT_VERSION,
+    }
+
+
+def _from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, tzlocal.get_localzone())
+
+
+def _to_ordinal(date):
+    # Laps without a start fix have no date
+    if date is None:
+        return float("nan")
+    return date.toordinal()
+
+
+def _from_ordinal(ordinal):
+    if np.isnan(ordinal):
+        return None
+    return datetime.fromordinal(int(ordinal))
+
+
+def load_laps(filename, parserClass):
+    """Return the cached laps for filename, or None if there's no
+    up to date cache entry"""
+    path = _entry_path(filename)
+    try:
+        with open(os.path.join(path, "meta.json")) as metafile:
+            meta = json.load(metafile)
+    except (IOError, ValueError):
+        return None
+
+    identity = meta.get("identity")
+    if identity != _identity(filename, parserClass):
+        logger.debug("Telemetry cache for %s is stale" % filename)
+        return None
+
+    def load(name):
+        return np.load(os.path.join(path, "%s.npy" % name), mmap_mode='r')
+
+    try:
+        columns = {}
+        for channel in meta["channels"]:
+            columns[channel] = load("column_%s" % channel)
+
+        distances = load("column_%s" % DISTANCE_COLUMN)
+        lap_rows = load("laps")
+        markers = dict([(name, load(name)) for name in MARKER_SETS])
+    except (IOError, ValueError, KeyError):
+        logger.warning("Corrupt telemetry cache for %s, rebuilding" % filename)
+        return None
+
+    table = TelemetryTable(columns, is_utc=meta["is_utc"])
+
+    laps = []
+    for position, row in enumerate(lap_rows):
+        fields = dict(zip(LAP_FIELDS, row))
+        start = int(fields["start"])
+        stop = int(fields["stop"])
+        lap_table = table.slice(start, stop)
+
+        analysis = {
+            "date": _from_ordinal(fields["date"]),
+            "lap_time": float(fields["lap_time"]),
+            "start_time": _from_epoch(fields["start_time"]),
+            "end_time": _from_epoch(fields["end_time"]),
+            "total_distance": float(fields["total_distance"]),
+            "distances": distances[start:stop],
+        }
+
+        for name in MARKER_SETS:
+            lap_markers = markers[name][markers[name][:, 0] == position]
+            analysis[name] = [{"metric": float(metric),
+                               "direction": int(direction),
+                               "fix": lap_table[int(fixrow)],
+                               "seconds": float(seconds)}
+                              for _, fixrow, seconds, metric, direction in lap_markers]
+
+        laps.append(Lap(float(fields["lapnum"]), lap_table, analysis))
+
+    logger.info("Loaded %s laps for %s from the telemetry cache" % (len(laps), filename))
+    return laps
+
+
+def save_laps(filename, parserClass, laps):
+    path = _entry_path(filename)
+    tmp_path = "%s.tmp%s" % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    try:
+        _write_entry(tmp_path, filename, parserClass, laps)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except:
+        # Don't leave a half written entry behind
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def _write_entry(tmp_path, filename, parserClass, laps):
+    def save(name, array):
+        np.save(os.path.join(tmp_path, "%s.npy" % name), array)
+
+    table = TelemetryTable.concatenate([lap.table for lap in laps])
+    for channel, column in table.columns.iteritems():
+        save("column_%s" % channel, column)
+
+    lap_rows = []
+    distances = []
+    markers = dict([(name, []) for name in MARKER_SETS])
+    start = 0
+    for position, lap in enumerate(laps):
+        stop = start + len(lap.table)
+        lap_rows.append([lap.lapnum, start, stop, lap.lap_time,
+                         utils.to_epoch(lap.start_time), utils.to_epoch(lap.end_time),
+                         _to_ordinal(lap.date), lap.total_distance])
+        distances.append(lap.distances)
+
+        for name in MARKER_SETS:
+            for marker in getattr(lap, name):
+                markers[name].append([position, marker["fix"].row, marker["seconds"],
+                                      marker["metric"], marker["direction"]])
+        start = stop
+
+    save("column_%s" % DISTANCE_COLUMN,
+         np.concatenate(distances) if distances else np.zeros(0))
+    save("laps", np.array(lap_rows, dtype=np.float64).reshape(-1, len(LAP_FIELDS)))
+    for name in MARKER_SETS:
+        save(name, np.array(markers[name], dtype=np.float64).reshape(-1, 5))
+
+    # meta.json goes in last, an entry without one is never used
+    with open(os.path.join(tmp_path, "meta.json"), "w") as metafile:
+        json.dump({"identity": _identity(filename, parserClass),
+                   "is_utc": table.is_utc,
+                   "channels": table.channels()}, metafile)
+
+
+def get_laps(filename, parserClass, rebuild=False):
+    """Laps for filename from the cache, parsing (and caching) the file
+    if needed"""
+    if not rebuild:
+        laps = load_laps(filename, parserClass)
+        if laps is not None:
+            return laps
+
+    with open(filename) as datafile:
+        laps = list(parserClass.iter_laps(datafile, filename=filename))
+
+    # The laps are parsed either way, a cache that can't be written
+    # shouldn't stop anything
+    try:
+        save_laps(filename, parserClass, laps)
+    except Exception:
+        logger.warning("Unable to write telemetry cache for %s" % filename, exc_info=True)
+
+    return laps
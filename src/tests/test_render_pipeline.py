@@ -0,0 +1,130 @@
+"""
+Renders a short clip (written out with OpenCV first) through
+BaseRenderer._check_pipeline(), the way render_laps() does before it
+trusts the render workers.  Run from src/ with
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cv2
+import numpy as np
+
+import seek_index
+
+from renderers import BaseRenderer, RenderParams
+from renderers.pipeline import RenderWorkers, can_fork
+
+WIDTH, HEIGHT, FPS, FRAMES = 160, 90, 30.0, 40
+
+
+class ClipVideo(object):
+    # Just what rendering needs of a models.Video, for a single file
+    def __init__(self, filename):
+        self.filenames = [filename]
+        self.fps = FPS
+        self.width = WIDTH
+        self.height = HEIGHT
+        self.frame_count = FRAMES
+        self.frame_offset = 0
+
+    def locate_frame(self, framenum):
+        return 0, framenum
+
+    def filename_number(self, framenum):
+        return 0
+
+
+class ClipLap(object):
+    lapnum = 1
+    lap_time = 1.0
+
+    def frame_telemetry(self, fps, lap_start_frame, start_frame, end_frame):
+        return None
+
+
+class PanelRenderer(BaseRenderer):
+    # A cached panel, some alpha blended text and a moving dot
+    def render_frame(self, frame, params, lapparams, framenum, lap):
+        with self.alpha(0.4, frame):
+            self.rounded_rectangle(frame, (10, 10), (150, 40), (255, 255, 255), 1,
+                                   cv2.CV_AA, 5, fill=True, fillColor=(50, 50, 50))
+            self.text(frame, str(framenum), (20, 32))
+        self.circle(frame, (10 + 3 * (framenum % 40), 70), 5, (0, 0, 255), -1)
+        return frame
+
+
+class WorkerOnlyRenderer(PanelRenderer):
+    # Draws something extra, but only in the render workers
+    parent = os.getpid()
+
+    def render_frame(self, frame, params, lapparams, framenum, lap):
+        frame = PanelRenderer.render_frame(self, frame, params, lapparams, framenum, lap)
+        if os.getpid() != self.parent:
+            frame[0, 0] = 255 - frame[0, 0]
+        return frame
+
+
+@unittest.skipUnless(can_fork(), "render workers need fork()")
+class CheckPipelineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Forked before anything starts a thread, as main does
+        cls.pool = RenderWorkers(2, WIDTH * HEIGHT * 3, 6)
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.tmpdir, "clip.avi")
+        # The check seeks back for its second render, leave that to OpenCV
+        # rather than indexing the clip into the video store
+        seek_index._indexes[cls.filename] = None
+
+        out = cv2.VideoWriter(cls.filename, cv2.cv.CV_FOURCC(*'MJPG'), FPS, (WIDTH, HEIGHT))
+        gradient = np.linspace(0, 255, WIDTH).astype(np.uint8)
+        for framenum in xrange(FRAMES):
+            frame = np.zeros((HEIGHT, WIDTH, 3), np.uint8)
+            frame[:, :, 0] = gradient
+            frame[:, :, 1] = (framenum * 6) % 256
+            out.write(frame)
+        out.release()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        seek_index._indexes.pop(cls.filename, None)
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    def params(self):
+        video = ClipVideo(self.filename)
+        params = RenderParams([(video, {"start_frame": 0, "end_frame": FRAMES - 1,
+                                        "lap": ClipLap()})], self.tmpdir)
+        params.set_bookend_time(0)
+        return video, params
+
+    def test_matching_render_is_trusted(self):
+        video, params = self.params()
+        try:
+            self.assertTrue(PanelRenderer(video)._check_pipeline(params, self.pool, frames=20))
+            # The check decoded with params' own captures, which are still there
+            ret, frame = params.get_framenum(params.laps[0], 20)
+            self.assertTrue(ret)
+            self.assertEqual(frame.shape, (HEIGHT, WIDTH, 3))
+        finally:
+            params.release()
+
+    def test_differing_render_is_not_trusted(self):
+        video, params = self.params()
+        try:
+            self.assertFalse(WorkerOnlyRenderer(video)._check_pipeline(params, self.pool,
+                                                                       frames=20))
+        finally:
+            params.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
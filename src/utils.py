@@ -1,10 +1,16 @@
+import calendar
 import config
+import fnmatch
+import json
 import logging
 import os
+import re
 import subprocess
 import tempfile
-import tzlocal
+import time
+import settings
 import wave
+import numpy as np
 try:
     import moviepy.editor as mp
 except:
@@ -14,42 +20,173 @@ except:
     imageio.plugins.ffmpeg.download()
 from moviepy.video.io import ffmpeg_tools
 from datetime import datetime
-from dateutil import parser
+from multiprocessing.pool import ThreadPool
+
+# strptime imports this lazily, which blows up if that first happens in
+# one of the probe threads
+import _strptime
 
-from math import radians, cos, sin, asin, sqrt
 from pydub import AudioSegment
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 needs the scandir backport, without it we make do with listdir
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 logger = logging.getLogger(__name__)
 
 CONFIG = None
 
-def creation_time(filename):
+# How many files to probe at once
+PROBE_WORKERS = 8
+
+def _ratio(text):
+    # ffprobe gives rates and timebases as "30000/1001"
+    try:
+        num, den = text.split("/")
+        return float(num) / float(den)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+def _creation_time(info, stream):
     """
-    From http://www.theeminentcodfish.com/gopro-timestamp/
+    GoPros write their local time into creation_time, with no zone, so
+    whatever ffprobe decorates it with is ignored and it's taken as local
+    (see http://www.theeminentcodfish.com/gopro-timestamp/)
     """
-    cmnd = ['ffprobe', '-show_format', '-pretty', '-loglevel', 'quiet', filename]
-    p = subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err =  p.communicate()
-    if err:
-        return None
-    t = out.splitlines()
+    for tags in (info.get("format", {}).get("tags", {}), stream.get("tags", {})):
+        stamp = tags.get("creation_time")
+        if not stamp:
+            continue
+        try:
+            return to_epoch(datetime.strptime(stamp[:19].replace("T", " "),
+                                              "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            continue
+
+    return None
+
+def _probe_with_cv2(filename, metadata):
+    # Without ffprobe all we can get is the basics (and no creation time)
+    import cv2
 
-    # TODO ZG: This feels remarkably fragile...
     try:
-        time = str(t[14][18:37])
-        lz =  tzlocal.get_localzone()
-        parsed = lz.localize(parser.parse(time))
-        return parsed
+        cap = cv2.VideoCapture(filename)
+        fps = cap.get(cv2.cv.CV_CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
+        width = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
+        cap.release()
     except:
+        return metadata
+
+    if fps and frame_count:
+        metadata.update({"fps": fps, "frame_count": frame_count,
+                         "width": width, "height": height, "valid": True})
+    return metadata
+
+def probe_video(filename):
+    """
+    fps, frame count, dimensions, stream timebase and creation time (epoch
+    seconds) of a video file, all from one ffprobe call.  "valid" is False
+    for anything without a usable video stream.
+    """
+    metadata = {"fps": None, "frame_count": None, "width": None, "height": None,
+                "time_base": None, "creation_time": None, "valid": False}
+
+    cmnd = ['ffprobe', '-v', 'quiet', '-print_format', 'json',
+            '-show_format', '-show_streams', filename]
+    try:
+        p = subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        logger.debug("ffprobe isn't available, falling back to cv2")
+        return _probe_with_cv2(filename, metadata)
+
+    out, _ = p.communicate()
+    try:
+        info = json.loads(out)
+    except ValueError:
+        return metadata
+
+    streams = [s for s in info.get("streams", []) if s.get("codec_type") == "video"]
+    if not streams:
+        return metadata
+    stream = streams[0]
+
+    fps = _ratio(stream.get("r_frame_rate")) or _ratio(stream.get("avg_frame_rate"))
+    try:
+        frame_count = int(stream.get("nb_frames") or 0)
+        if not frame_count and fps:
+            duration = stream.get("duration") or info.get("format", {}).get("duration")
+            frame_count = int(round(float(duration) * fps))
+    except (TypeError, ValueError):
+        frame_count = 0
+
+    metadata["creation_time"] = _creation_time(info, stream)
+    metadata["time_base"] = stream.get("time_base")
+    if fps and frame_count:
+        metadata.update({"fps": fps, "frame_count": frame_count,
+                         "width": int(stream.get("width", 0)),
+                         "height": int(stream.get("height", 0)),
+                         "valid": True})
+
+    return metadata
+
+def probe_videos(filenames, workers=PROBE_WORKERS):
+    """
+    Probe whichever of filenames the video store doesn't know about yet, a
+    few at a time, and queue the results in the store.  filenames can be a
+    generator, each file starts probing as soon as it turns up.  Returns
+    the list of filenames.
+    """
+    import video_store
+
+    found = []
+    probing = []
+    pool = None
+    try:
+        for filename in filenames:
+            found.append(filename)
+            if video_store.lookup(filename) is not None:
+                continue
+
+            if pool is None:
+                pool = ThreadPool(max(1, workers))
+            probing.append((filename, pool.apply_async(probe_video, (filename,))))
+
+        if probing:
+            logger.info("Probing %s video files..." % len(probing))
+        for filename, result in probing:
+            video_store.record(filename, result.get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return found
+
+
+GOPRO_NAME = re.compile(r"^(GOPR|G[PHX](\d\d))(\d{4})\.", re.IGNORECASE)
+
+def gopro_chapter(filename):
+    """(file number, chapter) for GoPro's GOPR0042.MP4 / GP010042.MP4 style
+    names, None for anything else"""
+    match = GOPRO_NAME.match(os.path.basename(filename))
+    if not match:
         return None
 
+    return (int(match.group(3)), int(match.group(2) or 0))
 
-def gopro_video_names_in_order(names1, names2):
-    if (("GOPR" in names1[0] or "GP01" in names2[0]) and
-        ("GOPR" in names2[0] or "GP01" in names2[0])):
-        return names1[0][-6:-4] == names2[0][-6:-4]
+def to_epoch(dt):
+    """Seconds since the epoch, naive datetimes are taken as local time"""
+    if dt.tzinfo is None:
+        return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
 
-    return False
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
 
 def within_x_sec(sec, dt1, dt2):
     return abs((dt1 - dt2).total_seconds()) < sec
@@ -65,44 +202,139 @@ def merge_audio_and_video(videofname, audiofname, outputfile):
     #subprocess.call(cmd, shell=True)
 
 
-def collect_videos(dirname, laps=None):
-    if not laps:
-        laps = []
+def _list_dir(path):
+    """(name, path, is_dir, is_file) for each entry of path.  scandir gets
+    the entry types from the directory listing itself, so nothing has to be
+    stat()ed"""
+    if scandir is not None:
+        return [(entry.name, entry.path, entry.is_dir(), entry.is_file())
+                for entry in scandir(path)]
 
-    try:
-        files = os.listdir(dirname)
-    except:
+    entries = []
+    for name in os.listdir(path):
+        fullpath = os.path.join(path, name)
+        entries.append((name, fullpath, os.path.isdir(fullpath), os.path.isfile(fullpath)))
+    return entries
+
+def find_videos(dirname, recursive=False, skip=None):
+    """
+    Yield the path of everything in dirname (and its subdirectories, if
+    recursive) that looks like a video, going by the extension alone.
+    Hidden files (e.g. the ._GOPR0001.MP4 files macOS leaves around) are
+    ignored, as is anything whose name or path relative to dirname matches
+    one of the skip globs.
+    """
+    skip = skip or []
+
+    def skipped(name, path):
+        relpath = os.path.relpath(path, dirname)
+        return any([fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern)
+                    for pattern in skip])
+
+    # Depth first, in name order
+    pending = [dirname]
+    while pending:
+        path = pending.pop()
+        try:
+            entries = sorted(_list_dir(path))
+        except OSError as e:
+            logger.warning("Unable to read %s: %s" % (path, e))
+            continue
+
+        subdirs = []
+        for name, fullpath, is_dir, is_file in entries:
+            if name.startswith(".") or skipped(name, fullpath):
+                continue
+
+            if is_dir:
+                subdirs.append(fullpath)
+            elif is_file and os.path.splitext(name)[1].lower() in settings.VALID_VIDEO_EXTENSIONS:
+                yield fullpath
+
+        if recursive:
+            pending.extend(reversed(subdirs))
+
+def collect_videos(dirname, recursive=False, skip=None):
+    if not os.path.isdir(dirname):
         logging.error("Invalid video directory provided")
         return []
 
-    videos = []
-    for fname in files:
-        logger.debug("Inspecting %s..." % fname)
+    # Files get probed (in parallel) as they're found
+    filenames = probe_videos(find_videos(dirname, recursive, skip))
 
-        from models import Video
+    from models import Video
+
+    videos = []
+    for filename in filenames:
+        logger.debug("Inspecting %s..." % filename)
 
-        video = Video(os.path.join(dirname, fname))
+        video = Video(filename)
         if video.is_valid():
-            # Gopro splits up videos every 12 mins, so join them together as far as data
-            # processing is concerned
-            prev_video, new_video = video.find_video_predecessor(videos)
-
-            if not prev_video:
-                videos.append(video)
-            else:
-                if prev_video == video:
-                    videos.remove(new_video)
-                    videos.append(prev_video)
-                    video = prev_video
-
-            video.match_laps(laps)
-            logging.info("Found a video: %s" % video)
+            videos.append(video)
         else:
             logging.debug("%s is not a video" % video)
 
+    # Gopro splits up videos every 12 mins, so join them together as far as data
+    # processing is concerned
+    videos = chain_chapters(videos)
+
+    for video in videos:
+        logging.info("Found a video: %s" % video)
+
+    # Write out everything we learned about the files in one go
+    import video_store
+    video_store.flush()
 
     return videos
 
+def chain_chapters(videos, tolerance=3):
+    """
+    Join single file videos that are really chapters of one recording.  In
+    start time (then chapter) order, each file continues the recording that
+    ends within tolerance seconds of its start, or the GoPro recording whose
+    previous chapter it is.
+    """
+    def order(video):
+        return (to_epoch(video.start_time), gopro_chapter(video.filenames[0]))
+
+    # Recordings are [first video, end time].  Index them by int(end time),
+    # and by the (file number, chapter) a GoPro recording would carry on with
+    recordings = []
+    by_end = {}
+    by_chapter = {}
+    for video in sorted(videos, key=order):
+        start = to_epoch(video.start_time)
+        chapter = gopro_chapter(video.filenames[0])
+
+        recording = None
+        if chapter:
+            recording = by_chapter.pop(chapter, None)
+
+        if recording is None:
+            for second in xrange(int(start) - tolerance - 1, int(start) + tolerance + 2):
+                for candidate in by_end.get(second, []):
+                    if abs(candidate[1] - start) < tolerance:
+                        recording = candidate
+                        break
+                if recording:
+                    break
+
+        if recording is None:
+            recording = [video, None]
+            recordings.append(recording)
+        else:
+            logger.debug("Merging %s and %s" % (recording[0].file_basenames(),
+                                                 video.file_basenames()))
+            by_end[int(recording[1])].remove(recording)
+            recording[0].append_chapter(video)
+
+        recording[1] = to_epoch(recording[0].end_time)
+        by_end.setdefault(int(recording[1]), []).append(recording)
+        if chapter:
+            by_chapter[(chapter[0], chapter[1] + 1)] = recording
+
+    return [video for video, _ in recordings]
+
 def mix_audiofiles(f1, f2, output):
     sound1 = AudioSegment.from_file(f1)
     sound2 = AudioSegment.from_file(f2)
@@ -167,20 +399,29 @@ def extract_audio(source, newaudiofile, start_time, duration):
 def haversine(lon1, lat1, lon2, lat2):
     """
     Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
+    on the earth (specified in decimal degrees), or between arrays of them
     http://stackoverflow.com/questions/15736995/how-can-i-quickly-estimate-the-distance-between-two-latitude-longitude-points
     """
     # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
     # haversine formula
     dlon = lon2 - lon1
     dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
     km = 6367 * c
     return km
 
 
+def cache_dir(name):
+    """Directory for on-disk caches, created on first use"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "zachslaprenderer", name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
 def load_config():
     global CONFIG
 
@@ -0,0 +1,164 @@
+"""
+What we've learned about each video file (fps, frame count, dimensions,
+creation time), kept in a SQLite database in the cache dir so a file only
+gets opened by cv2 / ffprobe once.  There's a row per file, checked against
+the file's size and mtime.  New rows are batched up and written in a single
+transaction, and SQLite's locking keeps concurrent runs from clobbering
+each other.  Frame indexes (see seek_index) live alongside in their own
+table.
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Bump when the meaning of a row changes, older rows are ignored
+SCHEMA_VERSION = 2
+
+FIELD_TYPES = [("fps", "REAL"),
+               ("frame_count", "INTEGER"),
+               ("width", "INTEGER"),
+               ("height", "INTEGER"),
+               ("time_base", "TEXT"),
+               ("creation_time", "REAL"),
+               ("valid", "INTEGER")]
+
+FIELDS = [name for name, _ in FIELD_TYPES]
+
+_local = threading.local()
+_pending = {}
+
+
+def _connect():
+    # sqlite connections can't be shared between threads, and don't
+    # survive a fork
+    if getattr(_local, "pid", None) != os.getpid():
+        path = os.path.join(utils.cache_dir("videos"), "metadata.sqlite")
+        connection = sqlite3.connect(path, timeout=30)
+        try:
+            # Readers don't block the writer (or vice versa)
+            connection.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error:
+            pass
+
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS videos ("
+                " path TEXT PRIMARY KEY, size INTEGER, mtime REAL, schema INTEGER, %s)" %
+                ", ".join(["%s %s" % field for field in FIELD_TYPES]))
+
+            # Databases from older versions are missing newer fields
+            existing = [row[1] for row in connection.execute("PRAGMA table_info(videos)")]
+            for name, sqltype in FIELD_TYPES:
+                if name not in existing:
+                    connection.execute("ALTER TABLE videos ADD COLUMN %s %s" % (name, sqltype))
+
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS frame_index ("
+                " path TEXT PRIMARY KEY, size INTEGER, mtime REAL,"
+                " pts BLOB, keyframes BLOB)")
+
+        _local.connection = connection
+        _local.pid = os.getpid()
+
+    return _local.connection
+
+
+def _identity(filename):
+    res = os.stat(filename)
+    return (os.path.abspath(filename), res.st_size, res.st_mtime)
+
+
+def lookup(filename):
+    """Stored metadata for filename, or None if it needs probing"""
+    path, size, mtime = _identity(filename)
+    if path in _pending:
+        return dict(_pending[path][1])
+
+    try:
+        row = _connect().execute(
+            "SELECT size, mtime, schema, %s FROM videos WHERE path = ?" % ", ".join(FIELDS),
+            (path,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("Unable to read the video metadata store: %s" % e)
+        return None
+
+    if not row or tuple(row[:3]) != (size, mtime, SCHEMA_VERSION):
+        return None
+
+    metadata = dict(zip(FIELDS, row[3:]))
+    metadata["valid"] = bool(metadata["valid"])
+    if metadata["time_base"] is not None:
+        metadata["time_base"] = str(metadata["time_base"])
+    return metadata
+
+
+def record(filename, metadata):
+    """Queue metadata for filename, flush() writes it out"""
+    identity = _identity(filename)
+    _pending[identity[0]] = (identity, dict(metadata))
+
+
+def flush():
+    if not _pending:
+        return
+
+    rows = []
+    for (path, size, mtime), metadata in _pending.itervalues():
+        rows.append([path, size, mtime, SCHEMA_VERSION] +
+                    [metadata.get(field) for field in FIELDS])
+
+    try:
+        connection = _connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO videos (path, size, mtime, schema, %s)"
+                " VALUES (%s)" % (", ".join(FIELDS), ", ".join(["?"] * (len(FIELDS) + 4))),
+                rows)
+    except sqlite3.Error as e:
+        logger.warning("Unable to write the video metadata store: %s" % e)
+        return
+
+    logger.debug("Stored metadata for %s videos" % len(rows))
+    _pending.clear()
+
+
+def lookup_frame_index(filename):
+    """(pts, keyframes) blobs stored for filename, or None"""
+    path, size, mtime = _identity(filename)
+    try:
+        row = _connect().execute(
+            "SELECT size, mtime, pts, keyframes FROM frame_index WHERE path = ?",
+            (path,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("Unable to read the video metadata store: %s" % e)
+        return None
+
+    if not row or tuple(row[:2]) != (size, mtime):
+        return None
+
+    return str(row[2]), str(row[3])
+
+
+def record_frame_index(filename, pts, keyframes):
+    """Store the (pts, keyframes) blobs for filename, straight away since
+    they're expensive to come by"""
+    path, size, mtime = _identity(filename)
+    try:
+        connection = _connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO frame_index (path, size, mtime, pts, keyframes)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime, sqlite3.Binary(pts), sqlite3.Binary(keyframes)))
+    except sqlite3.Error as e:
+        logger.warning("Unable to write the video metadata store: %s" % e)
+
+
+atexit.register(flush)